@@ -6,12 +6,23 @@ from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
 from flasgger import Swagger
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from db.database import db
+from app.utils.fields import FieldSelectionError
+from app.utils.filters import FilterError
+from app.utils.json_provider import FastJSONProvider
+from app.utils.pagination import NEXT_CURSOR_HEADER, PaginationError
+from app.utils.revocation import register_revocation_check
+from app.utils.query_stats import QUERY_COUNT_HEADER, SERVER_TIMING_HEADER, init_query_stats
 
 
 def create_app():
     
     app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    if Config.TRUSTED_PROXIES:
+        # request.remote_addr becomes the client address the trusted proxies saw
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.TRUSTED_PROXIES)
     # app.secret_key = Config.SECRET
     # app.config['SQLALCHEMY_DATABASE_URI'] = Config.SQLALCHEMY_DATABASE_URI
     # app.config['SQLALCHEMY_DATABASE_URI'] = Config.DB_CONNECTION_GLOBAL
@@ -21,7 +32,7 @@ def create_app():
     app.config['JWT_REFRESH_TOKEN_EXPIRES'] = 30 * 24 * 60 * 60
     app.config['JWT_SECRET_KEY'] = Config.JWT_SECRET_KEY
 
-    JWTManager(app)
+    jwt = JWTManager(app)
     app.config['SWAGGER'] = {
         'title': 'QR Code Generation API',
         'uiversion': 3,
@@ -50,6 +61,7 @@ def create_app():
                 "Authorization", 
                 "Access-Control-Allow-Credentials"
             ],
+            "expose_headers": [NEXT_CURSOR_HEADER, "ETag", QUERY_COUNT_HEADER, SERVER_TIMING_HEADER],
             "supports_credentials": True,
             "methods": ["GET", "POST", "PATCH", "PUT", "DELETE", "OPTIONS"]
         }
@@ -57,10 +69,20 @@ def create_app():
 
 
     from .blueprints import register_routes
+    from .blueprints.auth.methods import register_user_loader
     register_routes(app)
+    register_user_loader(jwt)
+    register_revocation_check(jwt)
+
+    @app.errorhandler(PaginationError)
+    @app.errorhandler(FieldSelectionError)
+    @app.errorhandler(FilterError)
+    def handle_query_argument_error(error):
+        return {"message": str(error)}, 400
 
     
     db.init_app(app)
     Migrate(app, db)
+    init_query_stats(app, report=Config.APP_ENV != 'production')
 
     return app
@@ -1,105 +1,196 @@
+import hashlib
+import threading
+from collections import defaultdict, namedtuple
+
 from app.blueprints.address.models import Address, City, Country, State
+from app.utils.cache_version import VersionStamp
+from app.utils.seeding import insert_missing
 from db.database import db
 
 
-def seed_countries():
-    countries_data = [
-        {"name": "United States", "iso_code": "US"},
-        {"name": "Canada", "iso_code": "CA"},
-        {"name": "India", "iso_code": "IN"},
-    ]
-    for country_data in countries_data:
-        country = Country.query.filter_by(name=country_data["name"]).first()
-        if not country:
-            country = Country(**country_data)
-            db.session.add(country)
-    db.session.commit()
-    print("Countries seeded successfully.")
-
-
-def seed_states():
-    states_data = [
-        # States for United States
-        {"name": "California", "country_name": "United States"},
-        {"name": "Texas", "country_name": "United States"},
-        # States for Canada
-        {"name": "Ontario", "country_name": "Canada"},
-        {"name": "Quebec", "country_name": "Canada"},
-        # States for India
-        {"name": "Maharashtra", "country_name": "India"},
-        {"name": "Karnataka", "country_name": "India"},
-    ]
-    for state_data in states_data:
-        country = Country.query.filter_by(name=state_data["country_name"]).first()
-        if country:
-            state = State.query.filter_by(
-                name=state_data["name"], country_id=country.id
-            ).first()
-            if not state:
-                state = State(name=state_data["name"], country_id=country.id)
-                db.session.add(state)
-    db.session.commit()
-    print("States seeded successfully.")
-
-
-def seed_cities():
-    cities_data = [
-        # Cities for California
-        {
-            "name": "Los Angeles",
-            "state_name": "California",
-            "postal_code_prefix": "900",
-        },
-        {
-            "name": "San Francisco",
-            "state_name": "California",
-            "postal_code_prefix": "941",
-        },
-        # Cities for Ontario
-        {"name": "Toronto", "state_name": "Ontario", "postal_code_prefix": "M5"},
-        {"name": "Ottawa", "state_name": "Ontario", "postal_code_prefix": "K1"},
-        # Cities for Maharashtra
-        {"name": "Mumbai", "state_name": "Maharashtra", "postal_code_prefix": "400"},
-        {"name": "Pune", "state_name": "Maharashtra", "postal_code_prefix": "411"},
-    ]
-    for city_data in cities_data:
-        state = State.query.filter_by(name=city_data["state_name"]).first()
-        if state:
-            city = City.query.filter_by(
-                name=city_data["name"], state_id=state.id
-            ).first()
-            if not city:
-                city = City(
-                    name=city_data["name"],
-                    state_id=state.id,
-                    postal_code_prefix=city_data["postal_code_prefix"],
-                )
-                db.session.add(city)
-    db.session.commit()
-    print("Cities seeded successfully.")
+GeoCountry = namedtuple('GeoCountry', 'id name iso_code')
+GeoState = namedtuple('GeoState', 'id name country_id')
+GeoCity = namedtuple('GeoCity', 'id name state_id postal_code_prefix')
+
+
+class GeoIndex:
+    """
+    Every country, state and city, with the children of each parent in id order.
+
+    Entries are namedtuples exposing the columns serializers read, so they stand in for
+    entities. An index is never modified once built; a change builds a new one.
+    """
+
+    def __init__(self, countries, states, cities):
+        self.countries = {country.id: country for country in countries}
+        self.states = {state.id: state for state in states}
+        self.cities = {city.id: city for city in cities}
+        self.country_list = list(countries)
+        self.states_by_country = defaultdict(list)
+        for state in states:
+            self.states_by_country[state.country_id].append(state)
+        self.cities_by_state = defaultdict(list)
+        for city in cities:
+            self.cities_by_state[city.state_id].append(city)
+        # derived from the content, so every worker holding the same data agrees on it
+        self.version = hashlib.blake2b(repr((countries, states, cities)).encode(), digest_size=16).hexdigest()
+
+    @classmethod
+    def load(cls):
+        return cls(
+            [GeoCountry._make(row) for row in db.session.query(Country.id, Country.name, Country.iso_code).order_by(Country.id)],
+            [GeoState._make(row) for row in db.session.query(State.id, State.name, State.country_id).order_by(State.id)],
+            [
+                GeoCity._make(row)
+                for row in db.session.query(City.id, City.name, City.state_id, City.postal_code_prefix).order_by(City.id)
+            ],
+        )
+
+    def covers(self, address):
+        return (
+            address.country_id in self.countries
+            and address.state_id in self.states
+            and address.city_id in self.cities
+        )
+
+
+class GeoSnapshot:
+    """
+    The GeoIndex of this process, loaded on first use and rebuilt when the geo
+    CacheVersion moves on, which any worker bumps after changing countries, states or
+    cities. Reads cost no query but the version check, at most every few seconds.
+    """
+
+    def __init__(self):
+        self.version_stamp = VersionStamp('geo')
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, refresh=False):
+        """The current index; with `refresh`, rebuilt now even if the version hasn't moved yet."""
+        version = self.version_stamp.current()
+        snapshot = self._index
+        if not refresh and snapshot is not None and snapshot[0] == version:
+            return snapshot[1]
+        with self._lock:
+            # threads that queued on the lock behind a rebuild use the index it built
+            if self._index is None or self._index[0] != version or (refresh and self._index is snapshot):
+                self._index = (version, GeoIndex.load())
+            return self._index[1]
+
+    def covering(self, addresses):
+        """
+        The index, rebuilt once if it lacks a country, state or city of `addresses`: rows
+        another worker added less than a version check ago.
+        """
+        geo = self.get()
+        if not all(geo.covers(address) for address in addresses):
+            geo = self.get(refresh=True)
+        return geo
 
+    def invalidate(self):
+        """Call after committing a geo change; every worker rebuilds its index from the new version."""
+        self.version_stamp.bump()
+        self._index = None
 
 
+geo_snapshot = GeoSnapshot()
+
+
+DEFAULT_COUNTRIES = [
+    {"name": "United States", "iso_code": "US"},
+    {"name": "Canada", "iso_code": "CA"},
+    {"name": "India", "iso_code": "IN"},
+]
+
+DEFAULT_STATES = [
+    # States for United States
+    {"name": "California", "country_name": "United States"},
+    {"name": "Texas", "country_name": "United States"},
+    # States for Canada
+    {"name": "Ontario", "country_name": "Canada"},
+    {"name": "Quebec", "country_name": "Canada"},
+    # States for India
+    {"name": "Maharashtra", "country_name": "India"},
+    {"name": "Karnataka", "country_name": "India"},
+]
+
+DEFAULT_CITIES = [
+    # Cities for California
+    {
+        "name": "Los Angeles",
+        "state_name": "California",
+        "postal_code_prefix": "900",
+    },
+    {
+        "name": "San Francisco",
+        "state_name": "California",
+        "postal_code_prefix": "941",
+    },
+    # Cities for Ontario
+    {"name": "Toronto", "state_name": "Ontario", "postal_code_prefix": "M5"},
+    {"name": "Ottawa", "state_name": "Ontario", "postal_code_prefix": "K1"},
+    # Cities for Maharashtra
+    {"name": "Mumbai", "state_name": "Maharashtra", "postal_code_prefix": "400"},
+    {"name": "Pune", "state_name": "Maharashtra", "postal_code_prefix": "411"},
+]
+
+
+# The seeders add the rows missing from the tables in the session's transaction and
+# return how many they added; the caller commits once. Rows come from the defaults
+# above or from fixture files (see load_fixture), a state names its country and a city
+# its state, and rows whose parent doesn't exist are skipped.
+
+def seed_countries(countries_data=None):
+    return insert_missing(Country, (DEFAULT_COUNTRIES if countries_data is None else countries_data), key=('name',))
+
+
+def seed_states(states_data=None):
+    country_ids = dict(db.session.query(Country.name, Country.id))
+    rows = [
+        {"name": state_data["name"], "country_id": country_ids[state_data["country_name"]]}
+        for state_data in (DEFAULT_STATES if states_data is None else states_data)
+        if state_data["country_name"] in country_ids
+    ]
+    return insert_missing(State, rows, key=('country_id', 'name'))
+
+
+def seed_cities(cities_data=None):
+    # a state name shared by several countries resolves to the first state created
+    state_ids = dict(db.session.query(State.name, State.id).order_by(State.id.desc()))
+    rows = [
+        {
+            "name": city_data["name"],
+            "state_id": state_ids[city_data["state_name"]],
+            "postal_code_prefix": city_data.get("postal_code_prefix"),
+        }
+        for city_data in (DEFAULT_CITIES if cities_data is None else cities_data)
+        if city_data["state_name"] in state_ids
+    ]
+    return insert_missing(City, rows, key=('state_id', 'name'))
 
 
 def get_address_details(user_id, is_primary=False):
     addresses = Address.query.filter_by(user_id=user_id, is_primary=is_primary).all()
+    geo = geo_snapshot.covering(addresses)
     addresses_list = []
     for address in addresses:
         
-        country = Country.query.filter_by(id=address.country_id).first()
+        country = geo.countries.get(address.country_id)
         if country is None:
             return {"message": "country not found"}, 404
 
-        city = City.query.filter_by(id=address.city_id).first()
+        city = geo.cities.get(address.city_id)
         if city is None:
             return {"message": "city not found"}, 404
 
-        state = State.query.filter_by(id=address.state_id).first()
+        state = geo.states.get(address.state_id)
         if state is None:
             return {"message": "state not found"}, 404
         
-        
+        # the city's own state and country, as the lazy city.state relationship gave
+        city_state = geo.states[city.state_id]
+        city_country = geo.countries[city_state.country_id]
         
         addresses_list.append(
             {
@@ -107,11 +198,11 @@ def get_address_details(user_id, is_primary=False):
                 "name": city.name,
                 "state": {
                     "id": city.state_id,
-                    "name": city.state.name,
+                    "name": city_state.name,
                 },
                 "country": {
-                    "id": city.state.country_id,
-                    "name": city.state.country.name,
+                    "id": city_state.country_id,
+                    "name": city_country.name,
                 },
                 "street_address":address.street_address,
                 "postal_code_prefix": city.postal_code_prefix,
@@ -123,9 +214,3 @@ def get_address_details(user_id, is_primary=False):
         
         
     return addresses_list
-        
-        
-        
-    
-    
-    
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, Enum
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Text, Enum, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
@@ -18,6 +18,9 @@ class Country(db.Model):
 
 class State(db.Model):
     __tablename__ = 'states'
+    __table_args__ = (
+        UniqueConstraint('country_id', 'name', name='uq_states_country_name'),
+    )
     
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
@@ -29,6 +32,9 @@ class State(db.Model):
 
 class City(db.Model):
     __tablename__ = 'cities'
+    __table_args__ = (
+        UniqueConstraint('state_id', 'name', name='uq_cities_state_name'),
+    )
     
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
@@ -1,13 +1,15 @@
-import json
-from app.blueprints.address.methods import seed_cities, seed_countries, seed_states
+import click
+from app.blueprints.address.methods import geo_snapshot, seed_cities, seed_countries, seed_states
 from flask import Blueprint, request, jsonify
 from .models import Address, Country, State, City
 from db.database import db
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func
+from app.utils.etag import check_etag, etag_headers
+from app.utils.pagination import page_headers, paginate, paginate_sorted
+from app.utils.seeding import load_fixture
 from flask_jwt_extended import (
     jwt_required,
-    get_jwt_identity,
+    get_current_user,
 )
 
 address_pg = Blueprint("address", __name__)
@@ -15,13 +17,31 @@ address_pg = Blueprint("address", __name__)
 
 @address_pg.route("/v1/address-seed", methods=["GET"])
 def seed_address_data():
-    seed_countries()
-    seed_states()
-    seed_cities()
+    added = seed_countries() + seed_states() + seed_cities()
+    db.session.commit()
+    if added:
+        geo_snapshot.invalidate()
 
     return "seeded successfully"
 
 
+@address_pg.cli.command("seed-geo")
+@click.option("--countries", type=click.Path(exists=True, dir_okay=False), help="JSON or CSV fixture: name, iso_code")
+@click.option("--states", type=click.Path(exists=True, dir_okay=False), help="JSON or CSV fixture: name, country_name")
+@click.option("--cities", type=click.Path(exists=True, dir_okay=False), help="JSON or CSV fixture: name, state_name, postal_code_prefix")
+def seed_geo_command(countries, states, cities):
+    """Add the missing countries, states and cities, the defaults or those of fixture files: flask address seed-geo"""
+    added = [
+        seed_countries(load_fixture(countries) if countries else None),
+        seed_states(load_fixture(states) if states else None),
+        seed_cities(load_fixture(cities) if cities else None),
+    ]
+    db.session.commit()
+    if any(added):
+        geo_snapshot.invalidate()
+    print("added {} countries, {} states and {} cities".format(*added))
+
+
 @address_pg.route("/v1/country", methods=["POST"])
 def add_country():
     """
@@ -118,6 +138,7 @@ def add_country():
 
         db.session.add(new_country)
         db.session.commit()
+        geo_snapshot.invalidate()
 
         return (
             jsonify(
@@ -152,9 +173,29 @@ def list_countries():
     summary: List all countries
     description: Returns a list of all countries in the database
     operationId: listCountries
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
     responses:
+      304:
+        description: Not modified since the ETag given in If-None-Match
       200:
-        description: Successful operation
+        description: Page of countries ordered by ID
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
+          ETag:
+            type: string
+            description: Weak validator of the listing, send it back in If-None-Match
         schema:
           type: array
           items:
@@ -178,7 +219,12 @@ def list_countries():
               type: string
               description: Error message
     """
-    countries = Country.query.all()
+    geo = geo_snapshot.get()
+    etag, not_modified = check_etag(geo.version)
+    if not_modified:
+        return not_modified
+
+    countries, next_cursor = paginate_sorted(geo.country_list, 'id')
 
     try:
         return (
@@ -195,6 +241,7 @@ def list_countries():
                 ]
             ),
             200,
+            {**page_headers(next_cursor), **etag_headers(etag)},
         )
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}, 500
@@ -276,7 +323,8 @@ def get_country_details(country_id):
                   type: string
                   example: Missing Authorization Header
     """
-    country = Country.query.filter_by(id=country_id).first()
+    geo = geo_snapshot.get()
+    country = geo.countries.get(country_id)
     if country is None:
         return {"message": "country not found"}, 404
     return (
@@ -288,7 +336,7 @@ def get_country_details(country_id):
                 # "created_at": country.created_at,
                 # "updated_at": country.updated_at,
                 "state": [
-                    {"id": state.id, "name": state.name} for state in country.states
+                    {"id": state.id, "name": state.name} for state in geo.states_by_country.get(country.id, [])
                 ],
             }
         ),
@@ -401,6 +449,7 @@ def update_country(country_id):
           country.iso_code = data["iso_code"]
 
       db.session.commit()
+      geo_snapshot.invalidate()
 
       return (
           jsonify(
@@ -546,6 +595,7 @@ def add_state():
 
         db.session.add(new_state)
         db.session.commit()
+        geo_snapshot.invalidate()
 
         return (
             jsonify(
@@ -586,9 +636,28 @@ def list_states(country_id):
         schema:
           type: integer
           example: 1
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
     responses:
+      304:
+        description: Not modified since the ETag given in If-None-Match
       200:
-        description: List of states for the specified country retrieved successfully.
+        description: Page of states for the specified country, ordered by ID.
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
+          ETag:
+            type: string
+            description: Weak validator of the listing, send it back in If-None-Match
         content:
           application/json:
             schema:
@@ -626,7 +695,12 @@ def list_states(country_id):
                   type: string
                   example: "An error occurred: <details>"
     """
-    states = State.query.filter_by(country_id=country_id).all()
+    geo = geo_snapshot.get()
+    etag, not_modified = check_etag(geo.version)
+    if not_modified:
+        return not_modified
+
+    states, next_cursor = paginate_sorted(geo.states_by_country.get(country_id, []), 'id')
 
     try:
         return (
@@ -637,7 +711,7 @@ def list_states(country_id):
                         "name": state.name,
                         "country": {
                             "id": state.country_id,
-                            "name": state.country.name,
+                            "name": geo.countries[state.country_id].name,
                             # "created_at": state.country.created_at,
                             # "updated_at": state.country.updated_at,
                         },
@@ -648,6 +722,7 @@ def list_states(country_id):
                 ]
             ),
             200,
+            {**page_headers(next_cursor), **etag_headers(etag)},
         )
     except Exception as e:
         return {"message": f"An error occurred: {str(e)}"}, 500
@@ -740,7 +815,8 @@ def get_state_details(state_id):
                 message:
                   type: string
     """
-    state = State.query.filter_by(id=state_id).first()
+    geo = geo_snapshot.get()
+    state = geo.states.get(state_id)
     if state is None:
         return {"message": "state not found"}, 404
     return (
@@ -750,7 +826,7 @@ def get_state_details(state_id):
                 "name": state.name,
                 "country": {
                     "id": state.country_id,
-                    "name": state.country.name,
+                    "name": geo.countries[state.country_id].name,
                     # "created_at": state.country.created_at,
                     # "updated_at": state.country.updated_at,
                 },
@@ -764,7 +840,7 @@ def get_state_details(state_id):
                         # "created_at": city.created_at,
                         # "updated_at": city.updated_at,
                     }
-                    for city in state.cities
+                    for city in geo.cities_by_state.get(state.id, [])
                 ],
             }
         ),
@@ -881,6 +957,7 @@ def update_state(state_id):
           state.country_id = data["country_id"]
 
       db.session.commit()
+      geo_snapshot.invalidate()
 
       return (
           jsonify(
@@ -1031,6 +1108,7 @@ def add_city():
 
       db.session.add(new_city)
       db.session.commit()
+      geo_snapshot.invalidate()
 
       return (
           jsonify(
@@ -1071,9 +1149,28 @@ def list_cities(state_id):
         schema:
           type: integer
           example: 101
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
     responses:
+      304:
+        description: Not modified since the ETag given in If-None-Match
       200:
-        description: List of cities retrieved successfully.
+        description: Page of cities retrieved successfully, ordered by ID.
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
+          ETag:
+            type: string
+            description: Weak validator of the listing, send it back in If-None-Match
         content:
           application/json:
             schema:
@@ -1142,7 +1239,12 @@ def list_cities(state_id):
                   type: string
 
     """
-    cities = City.query.filter_by(state_id=state_id).all()
+    geo = geo_snapshot.get()
+    etag, not_modified = check_etag(geo.version)
+    if not_modified:
+        return not_modified
+
+    cities, next_cursor = paginate_sorted(geo.cities_by_state.get(state_id, []), 'id')
 
     return (
         jsonify(
@@ -1154,13 +1256,13 @@ def list_cities(state_id):
                     # "updated_at": city.updated_at,
                     "state": {
                         "id": city.state_id,
-                        "name": city.state.name,
+                        "name": geo.states[city.state_id].name,
                         # "created_at": city.state.created_at,
                         # "updated_at": city.state.updated_at,
                     },
                     "country": {
-                        "id": city.state.country_id,
-                        "name": city.state.country.name,
+                        "id": geo.states[city.state_id].country_id,
+                        "name": geo.countries[geo.states[city.state_id].country_id].name,
                         # "created_at": city.state.country.created_at,
                         # "updated_at": city.state.country.updated_at,
                     },
@@ -1170,6 +1272,7 @@ def list_cities(state_id):
             ]
         ),
         200,
+        {**page_headers(next_cursor), **etag_headers(etag)},
     )
 
 
@@ -1259,7 +1362,8 @@ def get_city_details(city_id):
                 message:
                   type: string
     """
-    city = City.query.filter_by(id=city_id).first()
+    geo = geo_snapshot.get()
+    city = geo.cities.get(city_id)
     if city is None:
         return {"message": "city not found"}, 404
     return (
@@ -1269,13 +1373,13 @@ def get_city_details(city_id):
                 "name": city.name,
                 "state": {
                     "id": city.state_id,
-                    "name": city.state.name,
+                    "name": geo.states[city.state_id].name,
                     # "created_at": city.state.created_at,
                     # "updated_at": city.state.updated_at,
                 },
                 "country": {
-                    "id": city.state.country_id,
-                    "name": city.state.country.name,
+                    "id": geo.states[city.state_id].country_id,
+                    "name": geo.countries[geo.states[city.state_id].country_id].name,
                     # "created_at": city.state.country.created_at,
                     # "updated_at": city.state.country.updated_at,
                 },
@@ -1407,6 +1511,7 @@ def update_city(city_id):
           city.postal_code_prefix = data["postal_code_prefix"]
 
       db.session.commit()
+      geo_snapshot.invalidate()
 
       return (
           jsonify(
@@ -1482,8 +1587,7 @@ def create_address():
       500:
         description: Internal server error
     """
-    payload = get_jwt_identity()
-    payload = json.loads(payload)
+    user = get_current_user()
     data = request.json
     
     if not data:
@@ -1517,7 +1621,7 @@ def create_address():
       country = Country.query.filter_by(id=data['country_id']).first()
       state = State.query.filter_by(id=data['state_id']).first()
       new_address = Address(
-          user_id=payload['user_id'],
+          user_id=user.id,
           lat=lat,
           lan=lan,
           street_address=data['street_address'],
@@ -1576,9 +1680,24 @@ def get_address():
       - bearerAuth: []
     summary: Get Addresses
     description: Retrieves a list of addresses associated with the authenticated user.
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
     responses:
       200:
-        description: A list of addresses.
+        description: A page of addresses, ordered by ID.
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
         content:
           application/json:
             schema:
@@ -1633,15 +1752,15 @@ def get_address():
       401:
         description: Unauthorized - Missing or invalid JWT.
   """
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
-  addresses = Address.query.filter_by(user_id=payload['user_id']).all()
+  user = get_current_user()
+  addresses, next_cursor = paginate(Address.query.filter_by(user_id=user.id), [Address.id])
   
+  geo = geo_snapshot.covering(addresses)
   addresses_list = []
   for address in addresses:
-    city = City.query.filter_by(id=address.city_id).first()
-    country = Country.query.filter_by(id=address.country_id).first()
-    state = State.query.filter_by(id=address.state_id).first()
+    city = geo.cities[address.city_id]
+    country = geo.countries[address.country_id]
+    state = geo.states[address.state_id]
     
     addresses_list.append(
       {
@@ -1665,7 +1784,7 @@ def get_address():
       }
     )
     
-  return {"address":addresses_list}, 200
+  return {"address":addresses_list}, 200, page_headers(next_cursor)
 
 
 
@@ -1,16 +1,93 @@
 
-from app.blueprints.address.models import Address, City, Country, State
+from app.blueprints.address.methods import geo_snapshot
+from app.blueprints.address.models import Address
+from app.blueprints.agency.models import Agency
+from app.utils.cache import TTLCache
+from app.utils.etag import get_version
+from app.utils.loader import get_loader
+from sqlalchemy import func
 # from app.blueprints.product.methods import get_product_details
 # from app.blueprints.qrcode.methods import get_qr_details
 
 
+# Serialized agencies shared by all requests of this process, keyed by agency id.
+# Each entry remembers the version it was built from and is ignored once the agency
+# row moves on, so updates made by other workers are picked up as well.
+agency_snapshot_cache = TTLCache(ttl=60 * 60, maxsize=10000)
+
+# columns read by listings, which load rows of these rather than Agency entities
+AGENCY_LISTING_COLUMNS = (
+  'id', 'name', 'address_id', 'icon_url', 'subscription_tier', 'monthly_qr_limit', 'created_at', 'updated_at',
+)
+
+
+def get_agency_version(agency):
+  # addresses are never edited in place, an agency moves to a new address row instead;
+  # the geo version covers the city, state and country names
+  return (agency.updated_at, agency.address_id, geo_snapshot.get().version)
+
+
+def get_cached_agency_details(agency):
+  cached = agency_snapshot_cache.get(agency.id)
+  if cached is not None and cached[0] == get_agency_version(agency):
+    return cached[1]
+  return None
+
+
+def invalidate_agency_snapshot(agency_id=None):
+  """Drop one agency's cached payload, or every cached payload when no id is given."""
+  if agency_id is None:
+    agency_snapshot_cache.clear()
+  else:
+    agency_snapshot_cache.delete(agency_id)
+
+
+def get_agencies_version():
+  """Version of the public agency listing: its size and latest agency change, in one query, and the geo version."""
+  return get_version(
+    func.count(Agency.id),
+    func.max(Agency.updated_at),
+    criteria=[Agency.is_visible == True],
+  ) + (geo_snapshot.get().version,)
+
+
 def get_agency_details(agency):
-  address = Address.query.filter_by(id=agency.address_id).first()
-  city = City.query.filter_by(id=address.city_id).first()
-  state = State.query.filter_by(id=address.state_id).first()
-  country = Country.query.filter_by(id=address.country_id).first()
+  """The returned dict is shared with other requests and must not be mutated."""
+  agency_details = get_cached_agency_details(agency)
+  if agency_details is not None:
+    return agency_details
+  
+  address = get_loader().load(Address, agency.address_id)
+  geo = geo_snapshot.covering([address])
+  city = geo.cities[address.city_id]
+  state = geo.states[address.state_id]
+  country = geo.countries[address.country_id]
+  
+  agency_details = serialize_agency(agency, address, city, state, country)
+  agency_snapshot_cache.set(agency.id, (get_agency_version(agency), agency_details))
+  return agency_details
+
+
+def get_agencies_details(agencies):
+  """Serialize many agencies, with one IN query for the addresses of those not cached, keyed by agency id."""
+  agencies_details = {}
+  missing = []
+  for agency in agencies:
+    agency_details = get_cached_agency_details(agency)
+    if agency_details is None:
+      missing.append(agency)
+    else:
+      agencies_details[agency.id] = agency_details
   
+  if missing:
+    get_loader().prime(Address, {agency.address_id for agency in missing})
+    for agency in missing:
+      agencies_details[agency.id] = get_agency_details(agency)
   
+  return {agency.id: agencies_details[agency.id] for agency in agencies}
+
+
+def serialize_agency(agency, address, city, state, country):
   return {
       "id": agency.id,
         "name": agency.name,
@@ -1,21 +1,23 @@
-import json
 import os
 
 from .models import QRCode
 from sqlalchemy import desc
 from app.blueprints.address.models import Address, City, Country, State
-from app.blueprints.agency.methods import get_agency_details
+from app.blueprints.agency.methods import AGENCY_LISTING_COLUMNS, get_agencies_details, get_agencies_version, get_agency_details, invalidate_agency_snapshot
 from app.blueprints.auth.models import User, UserType
 from app.blueprints.product.methods import generate_random_filename
 from app.blueprints.product.models import Product
 from app.blueprints.profile.models import Profile
 from config.config import Config
 from flask import Blueprint, request, jsonify
+from app.utils.etag import check_etag, etag_headers
+from app.utils.pagination import page_headers, paginate
+from app.utils.read_models import project
 from db.database import db
 from .models import Agency, AgencyStatus
 from flask_jwt_extended import (
     jwt_required,
-    get_jwt_identity,
+    get_current_user,
 )
 
 agency_bp = Blueprint("agency_bp", __name__)
@@ -216,9 +218,7 @@ def create_agency():
                   type: string
                   description: Error message.
     """
-    payload = get_jwt_identity()
-    payload = json.loads(payload)
-    user = User.query.filter_by(id=payload['user_id']).first()
+    user = get_current_user()
     if user is None:
       return {"message": "user not found"}, 200
 
@@ -314,9 +314,29 @@ def get_companies():
     ---
     tags:
       - Companies
+    parameters:
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
     responses:
+      304:
+        description: Not modified since the ETag given in If-None-Match
       200:
-        description: A list of companies
+        description: A page of companies, oldest first
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
+          ETag:
+            type: string
+            description: Weak validator of the listing, send it back in If-None-Match
         content:
           application/json:
             schema:
@@ -367,17 +387,17 @@ def get_companies():
                     type: string
                     format: date-time
     """
-    agencies = Agency.query.filter_by(is_visible=True).all()
-
-    agency_list = []
-    for agency in agencies:
-      agency_details = get_agency_details(agency)
-        
-      agency_list.append(
-        agency_details
-      )
+    etag, not_modified = check_etag(get_agencies_version())
+    if not_modified:
+      return not_modified
+
+    agencies, next_cursor = paginate(
+      project(Agency, AGENCY_LISTING_COLUMNS).filter_by(is_visible=True), [Agency.id]
+    )
+
+    agency_list = list(get_agencies_details(agencies).values())
     return (
-        jsonify(agency_list), 200
+        jsonify(agency_list), 200, {**page_headers(next_cursor), **etag_headers(etag)}
     )
 
 
@@ -461,9 +481,6 @@ def get_agency(agency_id):
 @agency_bp.route('/v1/agency/subscribe', methods=['PATCH'])
 @jwt_required()
 def subscribe():
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
-  
   file = request.files['file']
   
   extension = file.filename.split('.')[-1]
@@ -474,7 +491,7 @@ def subscribe():
   file_path = os.path.join(Config.IMAGE_ICONS_URL, file_name)
   file.save(file_path)
 
-  user = User.query.filter_by(id=payload['user_id']).first()
+  user = get_current_user()
   agency = Agency.query.filter_by(id=user.agency_id).first()
   agency.is_subscribed = True
   db.sessions.commit()
@@ -602,6 +619,7 @@ def upload_category_logo(agency_id):
     
     agency.icon_url=Config.IMAGE_ICONS_GLOBAL_URL+file_name
     db.session.commit()
+    invalidate_agency_snapshot(agency.id)
     
     agency_details = get_agency_details(agency)
     return jsonify(agency_details), 200
@@ -719,6 +737,7 @@ def update_agency(agency_id):
             agency.address_id = data["address_id"]
 
         db.session.commit()
+        invalidate_agency_snapshot(agency.id)
         agency_details = get_agency_details(agency)
         return jsonify(
             agency_details
@@ -807,13 +826,11 @@ def delete_agency(agency_id):
           user.is_visible = False
           
         db.session.commit()
+        invalidate_agency_snapshot(agency_id)
         # Return a list of all visible companies after deletion
-        companies = Agency.query.filter_by(is_visible=True).all()
+        companies = project(Agency, AGENCY_LISTING_COLUMNS).filter_by(is_visible=True).all()
         return jsonify(
-          [
-            get_agency_details(agency)
-            for agency in companies
-          ]
+          list(get_agencies_details(companies).values())
         ), 200
     except Exception as e:
         db.session.rollback()
@@ -884,10 +901,7 @@ def approve_agency_files(agency_id):
       description: Unauthorized - JWT token missing or invalid
   """
   
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
-  
-  user = User.query.filter_by(id=payload['user_id']).first()
+  user = get_current_user()
   if user.user_type != UserType.SUPERADMIN:
     return {"message": "you don't have permission to approve"}, 400
   
@@ -899,6 +913,7 @@ def approve_agency_files(agency_id):
   # user = User.query.filter_by(agency_id=agency.id).first()
   # user.is_verified = True
   db.session.commit()
+  invalidate_agency_snapshot(agency.id)
   
   agency_details = get_agency_details(agency)
   return agency_details, 200
@@ -966,10 +981,7 @@ def reject_agency_files(agency_id):
       description: Unauthorized - JWT token missing or invalid
   """
   
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
-  
-  user = User.query.filter_by(id=payload['user_id']).first()
+  user = get_current_user()
   if user.user_type != UserType.SUPERADMIN:
     return {"message": "you don't have permission to reject"}, 400
   
@@ -979,6 +991,7 @@ def reject_agency_files(agency_id):
     return {"message": "agency not found"}, 404
   agency.status = AgencyStatus.REJECTED
   db.session.commit()
+  invalidate_agency_snapshot(agency.id)
   
   agency_details = get_agency_details(agency)
   return agency_details, 200
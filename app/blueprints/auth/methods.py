@@ -1,40 +1,45 @@
 
+import csv
+from datetime import datetime, timedelta
 from functools import wraps
+import hashlib
+import hmac
+import io
 import json
 import random
 import string
 from app.blueprints.agency.models import Agency
 from app.blueprints.profile.models import Profile
+from app.utils.cache import TTLCache
+from app.utils.cache_version import VersionStamp
+from app.utils.loader import get_loader
+from app.utils.passwords import hash_passwords
+from app.utils.seeding import insert_missing
+from app.utils.throttle import DatabaseBucketStore, MemoryBucketStore, Throttle
+from config.config import Config
 from db.database import db
-from app.blueprints.auth.models import Permission, Role, RolePermission, RoleType, User
+from app.blueprints.auth.models import OTPResetToken, Permission, Role, RolePermission, RoleType, User, UserType
+from app.utils.validators import generate_otp, is_valid_email, is_valid_phone_number
 from flask_jwt_extended import (
-    get_jwt_identity,
+    get_jwt,
 )
+from sqlalchemy import event, insert, inspect, or_
+from sqlalchemy.orm import make_transient_to_detached
 from flask import jsonify
 
 def permission_required(*permission_names):
+    """
+    Allow the request when the token grants any of the (type, name) permissions given,
+    checked against the bitmask claim of the token without reading the database.
+    """
+    required = get_required_permissions_mask(permission_names)
+
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            payload = get_jwt_identity()
-            payload = json.loads(payload)
-            user = User.query.filter_by(id=payload['user_id']).first()
-
-            if not user:
-                return jsonify({"message": "User not found"}), 404
-
-            # role = Role.query.filter_by(id=user.role_id).first()
-            # if not role:
-            #     return jsonify({"message": "Role not found"}), 404
-
-            user_permissions = payload.get('permissions', [])
-
-            for permission_type, permission_name in permission_names:
-                if any(
-                    perm.get('type') == permission_type and perm.get('name') == permission_name
-                    for perm in user_permissions
-                ):
-                    return f(*args, **kwargs)
+            granted = get_jwt().get(PERMISSIONS_CLAIM, 0)
+            if granted & required:
+                return f(*args, **kwargs)
 
             return jsonify({"message": "Permission denied"}), 403
 
@@ -67,37 +72,290 @@ def generate_password(length=12, use_uppercase=True, use_numbers=True, use_speci
 
 
 def seed_permissions():
-    permissions = ["read", 'write', 'delete', 'update']
-    scopes = ["qr", 'user']
-    
-    # Create permissions
-    for permission in permissions:
-        for scope in scopes:
-            new_permission = Permission(
-                type=permission,
-                name=scope
-            )
-            db.session.add(new_permission)
-            db.session.commit()
-    
+    """Add the missing global permissions, in the session's transaction; returns how many were added."""
+    rows = [{"type": permission_type, "name": permission_name} for permission_type, permission_name in PERMISSIONS]
+    return insert_missing(Permission, rows, key=('type', 'name'), criteria=[Permission.agency_id.is_(None)])
+
 
 def seed_roles():
-    # Create roles using RoleType enum
-    for role_type in RoleType:
-        new_role = Role(
-            name=role_type.value,
-            role_enum=list(RoleType).index(role_type)
-        )
-        db.session.add(new_role)
+    """Add the missing RoleType roles, in the session's transaction; returns how many were added."""
+    rows = [
+        {"name": role_type.value, "role_enum": role_enum}
+        for role_enum, role_type in enumerate(RoleType)
+    ]
+    return insert_missing(Role, rows, key=('name',))
+
+
+# Permissions of each role shared by all requests of this process, keyed by role id.
+# Entries remember the role_permissions version they were built from, which any worker
+# bumps when it changes a role's permissions.
+role_permissions_cache = TTLCache(ttl=60 * 60, maxsize=1000)
+role_permissions_version = VersionStamp('role_permissions')
+
+
+def get_cached_role_permissions_map(role_ids):
+    """get_role_permissions_map() served from memory, only roles not cached at the current version are queried."""
+    role_ids = set(role_ids)
+    version = role_permissions_version.current()
+    permissions_map = {
+        role_id: permissions
+        for role_id, (entry_version, permissions) in role_permissions_cache.get_many(role_ids).items()
+        if entry_version == version
+    }
+
+    missing = role_ids - permissions_map.keys()
+    if missing:
+        fetched = get_role_permissions_map(missing)
+        role_permissions_cache.set_many({role_id: (version, permissions) for role_id, permissions in fetched.items()})
+        permissions_map.update(fetched)
+    return permissions_map
+
+
+def invalidate_role_permissions():
+    """Call after committing a change to role permissions, it reaches the other workers through the version."""
+    role_permissions_cache.clear()
+    role_permissions_version.bump()
+
+
+# Global permissions, as (type, name). The position of a pair is its bit in the token
+# claim, the same in every environment whatever the permission ids: append new pairs,
+# never reorder or remove one.
+PERMISSIONS = (
+    ('read', 'qr'), ('read', 'user'),
+    ('write', 'qr'), ('write', 'user'),
+    ('delete', 'qr'), ('delete', 'user'),
+    ('update', 'qr'), ('update', 'user'),
+)
+PERMISSION_BITS = {permission: bit for bit, permission in enumerate(PERMISSIONS)}
+
+# Token claim holding the permissions granted to the user, as a bitmask with the
+# PERMISSION_BITS bit of each of them set.
+PERMISSIONS_CLAIM = 'pm'
+
+
+def get_permissions_mask(permissions):
+    """Mask of permission dicts; permissions outside PERMISSIONS (agency defined ones) have no bit."""
+    mask = 0
+    for permission in permissions:
+        bit = PERMISSION_BITS.get((permission["type"], permission["name"]))
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+
+def get_required_permissions_mask(permission_names):
+    """Mask of the (type, name) pairs, any of which is enough."""
+    unknown = [permission for permission in permission_names if permission not in PERMISSION_BITS]
+    if unknown:
+        raise ValueError(f"permissions without a token bit: {unknown}")
+    return get_permissions_mask(
+        {"type": permission_type, "name": permission_name} for permission_type, permission_name in permission_names
+    )
+
+
+def get_token_identity(user):
+    return json.dumps({"user_id": str(user.id)})
+
+
+def get_token_claims(user):
+    """Claims added to the user's tokens: the bitmask of the permissions granted by their role."""
+    if user.role_id is None:
+        return {PERMISSIONS_CLAIM: 0}
+    permissions = get_cached_role_permissions_map([user.role_id])[user.role_id]
+    return {PERMISSIONS_CLAIM: get_permissions_mask(permissions)}
+
+
+def get_role_permissions_map(role_ids):
+    """
+    Permissions granted to each role of `role_ids`, resolved with one query joining
+    role_permission to permission, as {role_id: [permission dict]}. The dicts may be
+    shared through the cache and must not be mutated.
+    """
+    role_ids = set(role_ids)
+    permissions_map = {role_id: [] for role_id in role_ids}
+    if not role_ids:
+        return permissions_map
+
+    rows = (
+        db.session.query(RolePermission.role_id, Permission)
+        .join(Permission, Permission.id == RolePermission.permission_id)
+        .filter(RolePermission.role_id.in_(role_ids))
+        .order_by(RolePermission.role_id, RolePermission.id)
+    )
+    for role_id, permission in rows:
+        permissions_map[role_id].append(serialize_permission(permission))
+    return permissions_map
+
+
+def serialize_permission(permission):
+    return {
+        "id": permission.id,
+        "type": permission.type,
+        "name": permission.name,
+        "created_at": permission.created_at,
+        "updated_at": permission.updated_at,
+    }
+
+
+def get_token_permissions(permissions):
+    # what tokens and login responses carry of each permission
+    return [
+        {"id": permission["id"], "type": permission["type"], "name": permission["name"]}
+        for permission in permissions
+    ]
+
+
+# Login attempts are throttled per client address and per account before any password
+# is hashed, so a credential stuffing burst can't take every worker's CPU.
+login_throttle_store = DatabaseBucketStore() if Config.LOGIN_THROTTLE_STORE == 'database' else MemoryBucketStore()
+login_ip_throttle = Throttle('login-ip', Config.LOGIN_IP_BURST, Config.LOGIN_IP_PER_MINUTE, login_throttle_store)
+login_account_throttle = Throttle(
+    'login-account', Config.LOGIN_ACCOUNT_BURST, Config.LOGIN_ACCOUNT_PER_MINUTE, login_throttle_store
+)
+
+
+def throttle_login(email, ip):
+    """Seconds to wait before this login may be attempted, or None when it may go ahead."""
+    # an address already over its budget doesn't spend the attempts of the account it targets
+    return login_ip_throttle.hit(ip) or login_account_throttle.hit(str(email or '').strip().lower())
+
+
+def get_login_throttle_stats():
+    return {
+        "store": Config.LOGIN_THROTTLE_STORE,
+        "ip": login_ip_throttle.stats(),
+        "account": login_account_throttle.stats(),
+    }
+
+
+OTP_TTL = timedelta(minutes=15)
+# a user may request at most OTP_MAX_PER_WINDOW codes in any OTP_WINDOW
+OTP_WINDOW = timedelta(hours=1)
+OTP_MAX_PER_WINDOW = 5
+
+
+def hash_otp(user_id, otp):
+    # keyed, so a leaked table can't be brute forced over the million possible codes
+    key = (Config.SECRET or Config.JWT_SECRET_KEY).encode()
+    return hmac.new(key, f"{user_id}:{otp}".encode(), hashlib.sha256).hexdigest()
+
+
+def issue_otp(user):
+    """
+    Replace the user's outstanding codes with a new one and return it, or None when the
+    user already requested OTP_MAX_PER_WINDOW codes within the last OTP_WINDOW.
+    """
+    now = datetime.utcnow()
+    window_start = now - OTP_WINDOW
+    # the user's rows that can no longer count or be verified go first
+    OTPResetToken.query.filter(
+        OTPResetToken.user_id == user.id,
+        OTPResetToken.created_at < window_start,
+    ).delete(synchronize_session=False)
+
+    recent = OTPResetToken.query.filter(
+        OTPResetToken.user_id == user.id,
+        OTPResetToken.created_at >= window_start,
+    ).count()
+    if recent >= OTP_MAX_PER_WINDOW:
         db.session.commit()
-    
-    
+        return None
+
+    # earlier codes stop working but are kept until they leave the window, to be counted
+    OTPResetToken.query.filter_by(user_id=user.id, is_used=False).update(
+        {OTPResetToken.is_used: True}, synchronize_session=False
+    )
+    otp = generate_otp()
+    db.session.add(OTPResetToken(user_id=user.id, otp_hash=hash_otp(user.id, otp), expires_at=now + OTP_TTL))
+    db.session.commit()
+    return otp
+
+
+def find_otp_token(user, otp):
+    return OTPResetToken.query.filter_by(user_id=user.id, otp_hash=hash_otp(user.id, otp), is_used=False).first()
+
+
+def purge_otp_tokens():
+    """Delete, in one statement, every used or expired code that no longer counts towards a rolling limit."""
+    now = datetime.utcnow()
+    deleted = OTPResetToken.query.filter(
+        OTPResetToken.created_at < now - OTP_WINDOW,
+        or_(OTPResetToken.is_used == True, OTPResetToken.expires_at < now),
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+# Column values of recently authenticated active users, keyed by user id. Updates made
+# in this worker drop the entry at once, other workers see them when it expires.
+current_user_cache = TTLCache(ttl=30, maxsize=10000)
+
+
+def load_current_user(user_id):
+    """The active user `user_id`, attached to the session without a query when it is cached."""
+    values = current_user_cache.get(user_id)
+    if values is not None:
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = User.query.filter_by(id=user_id, is_active=True).first()
+    if user is not None:
+        current_user_cache.set(
+            user_id, {attribute.key: getattr(user, attribute.key) for attribute in inspect(User).column_attrs}
+        )
+    return user
+
+
+def invalidate_current_user(user_id):
+    current_user_cache.delete(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_current_user(mapper, connection, user):
+    invalidate_current_user(user.id)
+
+
+def register_user_loader(jwt):
+    """Resolve the caller of every JWT protected request once, as get_current_user()."""
+    @jwt.user_lookup_loader
+    def user_lookup_callback(_jwt_header, jwt_data):
+        # reset tokens carry the bare user id; no user here means the usual 401
+        try:
+            user_id = int(json.loads(jwt_data["sub"])["user_id"])
+        except (ValueError, TypeError, KeyError):
+            return None
+        return load_current_user(user_id)
+
+    @jwt.user_lookup_error_loader
+    def user_lookup_error_callback(_jwt_header, jwt_data):
+        return {"message": "user not found"}, 401
+
+
+# columns read by listings, which load rows of these rather than User entities
+USER_LISTING_COLUMNS = (
+    'id', 'email', 'first_name', 'last_name', 'phone_number', 'role_id', 'user_type',
+    'agency_id', 'is_active', 'is_verified', 'created_at', 'updated_at',
+)
+
 
-        
-        
 def get_user_details(user):
-    role = Role.query.filter_by(id=user.role_id).first()
-    profile = Profile.query.filter_by(user_id=user.id).first()
+    loader = get_loader()
+    role = loader.load(Role, user.role_id)
+    profile = loader.load(Profile, user.id, column='user_id')
+    return serialize_user(user, role, profile)
+
+
+def get_users_details(users):
+    """Serialize many users with one Role and one Profile IN query, keyed by user id."""
+    loader = get_loader()
+    loader.prime(Role, {user.role_id for user in users})
+    loader.prime(Profile, {user.id for user in users}, column='user_id')
+    return {user.id: get_user_details(user) for user in users}
+
+
+def serialize_user(user, role, profile):
     return {
               "id": user.id,
               "email": user.email,
@@ -112,11 +370,110 @@ def get_user_details(user):
                   "id":profile.id,
                   "phone_number":profile.phone_number,
                   "is_visible":profile.is_visible
-              },
+              } if profile is not None else None,
               "is_verified": user.is_verified,
               "is_active": user.is_active,
               "user_type": user.user_type.value,
               "created_at": user.created_at,
               "updated_at": user.updated_at,
               
-          }
\ No newline at end of file
+          }
+
+# columns of the header row of a bulk invite CSV
+INVITE_COLUMNS = ('first_name', 'last_name', 'email', 'phone_number', 'role_id')
+
+
+class InviteError(ValueError):
+    pass
+
+
+def read_invite_csv(content):
+    """Rows of an invite CSV file (bytes): a header naming INVITE_COLUMNS, then one user per row."""
+    try:
+        reader = csv.DictReader(io.StringIO(content.decode('utf-8-sig')))
+        missing = set(INVITE_COLUMNS) - set(reader.fieldnames or ())
+        if missing:
+            raise InviteError(f"missing columns: {', '.join(sorted(missing))}")
+        rows = []
+        for row in reader:
+            if len(rows) == Config.BULK_INVITE_MAX_ROWS:
+                raise InviteError(f"at most {Config.BULK_INVITE_MAX_ROWS} users can be invited at once")
+            rows.append({column: (row.get(column) or '').strip() for column in INVITE_COLUMNS})
+    except (UnicodeDecodeError, csv.Error):
+        raise InviteError("file must be a UTF-8 encoded CSV")
+    return rows
+
+
+def validate_invites(rows):
+    """Errors of every row, in order; roles and taken emails are looked up once for the whole file."""
+    role_ids = {int(row['role_id']) for row in rows if row['role_id'].isdigit()}
+    existing_roles = {role_id for (role_id,) in db.session.query(Role.id).filter(Role.id.in_(role_ids))}
+    emails = {row['email'] for row in rows if row['email']}
+    # emails are unique among deactivated users too
+    taken = {email for (email,) in db.session.query(User.email).filter(User.email.in_(emails))}
+
+    seen = set()
+    errors = []
+    for row in rows:
+        row_errors = [f"{column} is required" for column in INVITE_COLUMNS if not row[column]]
+        if row['email'] and not is_valid_email(row['email']):
+            row_errors.append("invalid email")
+        elif row['email'] in taken:
+            row_errors.append("email is already exist")
+        elif row['email'] in seen:
+            row_errors.append("email is repeated in the file")
+        seen.add(row['email'])
+        if row['phone_number'] and not is_valid_phone_number(row['phone_number']):
+            row_errors.append("invalid phone number")
+        if row['role_id'] and not (row['role_id'].isdigit() and int(row['role_id']) in existing_roles):
+            row_errors.append("role not found")
+        errors.append(row_errors)
+    return errors
+
+
+def invite_users(rows, agency_id):
+    """
+    Create a user and a profile for every valid row, with generated passwords hashed in
+    one batch on the bulk hashing processes and two bulk INSERTs, in the session's
+    transaction; returns the per-row report, with the password of each created user.
+    """
+    errors = validate_invites(rows)
+    valid = [row for row, row_errors in zip(rows, errors) if not row_errors]
+    passwords = [generate_password() for _ in valid]
+    user_ids = {}
+    if valid:
+        # keyed by the unique email rather than relying on RETURNING order, which would
+        # cost SQLite a statement per row
+        user_ids = dict(db.session.execute(
+            insert(User).returning(User.email, User.id),
+            [
+                {
+                    "email": row['email'],
+                    "first_name": row['first_name'],
+                    "last_name": row['last_name'],
+                    "phone_number": row['phone_number'],
+                    "agency_id": agency_id,
+                    "user_type": UserType.USER,
+                    "role_id": int(row['role_id']),
+                    "password_hash": password_hash,
+                }
+                for row, password_hash in zip(valid, hash_passwords(passwords))
+            ],
+        ).all())
+        db.session.execute(
+            insert(Profile),
+            [{"user_id": user_ids[row['email']], "phone_number": row['phone_number']} for row in valid],
+        )
+
+    created = iter(passwords)
+    report = []
+    # line numbers as a spreadsheet shows them, the header being line 1
+    for line, (row, row_errors) in enumerate(zip(rows, errors), start=2):
+        if row_errors:
+            report.append({"row": line, "email": row['email'], "status": "invalid", "errors": row_errors})
+        else:
+            report.append({
+                "row": line, "email": row['email'], "status": "created",
+                "id": user_ids[row['email']], "password": next(created),
+            })
+    return report
@@ -2,7 +2,7 @@ from datetime import datetime
 from db.database import db
 from sqlalchemy import func, Enum as SQLAlchemyEnum
 from enum import Enum
-from werkzeug.security import check_password_hash
+from app.utils.passwords import verify_password
 
 
 class UserType(Enum):
@@ -19,6 +19,12 @@ class RoleType(Enum):
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        # the user directory pages in id order, within an agency or a role when filtered;
+        # the active and verified flags are checked on the rows of that range
+        db.Index('ix_users_agency_directory', 'agency_id', 'id'),
+        db.Index('ix_users_role_directory', 'role_id', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False, index=True)
@@ -39,7 +45,7 @@ class User(db.Model):
 
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
 
     
 
@@ -47,7 +53,7 @@ class Role(db.Model):
     __tablename__ = 'roles'
     
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String)
+    name = db.Column(db.String, unique=True)
     role_enum = db.Column(db.Integer)
     # agency_id = db.Column(db.Integer, db.ForeignKey('agencies.id'))
     created_at = db.Column(db.DateTime, default=func.now())
@@ -57,6 +63,13 @@ class Role(db.Model):
 
 class Permission(db.Model):
     __tablename__ = 'permission'
+    __table_args__ = (
+        # one global permission per (type, name), which is what lets seeding skip existing ones
+        db.Index(
+            'uq_permission_global', 'type', 'name', unique=True,
+            postgresql_where=db.text('agency_id IS NULL'), sqlite_where=db.text('agency_id IS NULL'),
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String)
@@ -82,12 +95,17 @@ class RolePermission(db.Model):
 
 class OTPResetToken(db.Model):
     __tablename__ = 'otp_reset_tokens'
+    __table_args__ = (
+        # verification is one probe of this index, whatever the user's history
+        db.Index('ix_otp_reset_tokens_lookup', 'user_id', 'otp_hash', 'is_used'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    otp = db.Column(db.String(6), nullable=False)
+    # HMAC of the code, see hash_otp
+    otp_hash = db.Column(db.String(64), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    expires_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
     is_used = db.Column(db.Boolean, default=False)
     
     user = db.relationship('User', backref='otp_reset_tokens')
@@ -1,23 +1,45 @@
 from datetime import datetime, timedelta
-import json
 from app.blueprints.address.methods import get_address_details
-from app.blueprints.agency.methods import get_agency_details
-from app.blueprints.auth.methods import generate_password, get_user_details, seed_permissions, seed_roles
+from app.blueprints.agency.methods import AGENCY_LISTING_COLUMNS, get_agencies_details, get_agency_details
+from app.blueprints.auth.methods import (
+    USER_LISTING_COLUMNS,
+    generate_password,
+    find_otp_token,
+    get_cached_role_permissions_map,
+    get_login_throttle_stats,
+    get_token_claims,
+    get_token_identity,
+    get_token_permissions,
+    get_user_details,
+    get_users_details,
+    seed_permissions,
+    invalidate_role_permissions,
+    invite_users,
+    InviteError,
+    issue_otp,
+    purge_otp_tokens,
+    seed_roles,
+    read_invite_csv,
+    throttle_login,
+)
 from app.blueprints.profile.models import Profile
 from flask_cors import cross_origin
 from flask import Blueprint, request, jsonify
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from app.utils.filters import get_bool_arg, get_int_arg
+from app.utils.pagination import page_headers, paginate
+from app.utils.passwords import needs_rehash
+from app.utils.read_models import project
+from app.utils.revocation import revocation_list
 from app.blueprints.agency.models import Agency
 
 from app.utils.validators import (
-    generate_otp,
     is_valid_email,
     is_valid_phone_number,
     set_password,
     validate_password,
 )
 from .models import (
-    OTPResetToken,
     RoleType,
     User,
     UserType,
@@ -30,7 +52,8 @@ from flask_jwt_extended import (
     create_access_token,
     create_refresh_token,
     jwt_required,
-    get_jwt_identity,
+    get_current_user,
+    get_jwt,
     decode_token,
 )
 
@@ -213,33 +236,15 @@ def sign_up():
     # if role is None:
     #       return {"message": "user does not have role"}, 400
 
-    role_permissions = RolePermission.query.filter_by(role_id=role.id).all()
-    permission_ids = [
-          role_permission.permission_id for role_permission in role_permissions
-      ]
-
-    permissions_list = []
-    for permission_id in permission_ids:
-      permission = Permission.query.filter_by(id=permission_id).first()
-
-      permissions_list.append(
-          {"id": permission.id, "type": permission.type, "name": permission.name}
-      )
+    permissions_list = get_token_permissions(get_cached_role_permissions_map([role.id])[role.id])
 
     access_token = create_access_token(
-          identity=json.dumps({"user_id": str(new_user.id)
-                                , "permissions": permissions_list
-                                }
-                              ),
-          # additional_claims=additional_claims,
+          identity=get_token_identity(new_user),
+          additional_claims=get_token_claims(new_user),
       )
 
     refresh_token = create_refresh_token(
-          identity=json.dumps({"user_id": str(new_user.id)
-                                , "permissions": permissions_list
-                                }
-                              ),
-          # additional_claims=additional_claims,
+          identity=get_token_identity(new_user),
       )
     
     user_details = get_user_details(new_user)
@@ -385,10 +390,7 @@ def add_user():
     except:
         return {"message": "can't receive the request"}, 400
 
-    payload = get_jwt_identity()
-    payload = json.loads(payload)
-    
-    user = User.query.filter_by(id=payload['user_id'], is_active=True).first()
+    user = get_current_user()
     
     agency = Agency.query.filter_by(id=user.agency_id).first()
     if agency is None and user.user_type != UserType.SUPERADMIN:
@@ -463,6 +465,112 @@ def add_user():
     #     return {"error": "couldn't add user"}, 400
 
 
+@auth_pg.route("/v1/user/bulk", methods=["POST"])
+@cross_origin(origins="*")
+@jwt_required()
+def invite_users_from_csv():
+    """
+    Invite users from a CSV file.
+    Creates a user and a profile, with a generated password, for every valid row of the
+    file, in the requester's agency. Invalid rows are reported and skipped.
+    ---
+    tags:
+      - User
+    security:
+        - bearerAuth: []
+    consumes:
+      - multipart/form-data
+    parameters:
+      - name: file
+        in: formData
+        type: file
+        required: true
+        description: UTF-8 CSV with the header first_name,last_name,email,phone_number,role_id (at most 1000 rows by default)
+    responses:
+      200:
+        description: Per-row report, in file order
+        schema:
+          type: object
+          properties:
+            created:
+              type: integer
+              example: 2
+            invalid:
+              type: integer
+              example: 1
+            rows:
+              type: array
+              items:
+                type: object
+                properties:
+                  row:
+                    type: integer
+                    example: 2
+                    description: Line of the row in the file, the header being line 1
+                  email:
+                    type: string
+                    example: "john.doe@example.com"
+                  status:
+                    type: string
+                    enum: [created, invalid]
+                  id:
+                    type: integer
+                    description: ID of the created user
+                  password:
+                    type: string
+                    description: Generated password of the created user
+                  errors:
+                    type: array
+                    items:
+                      type: string
+                    example: ["invalid phone number"]
+      400:
+        description: Missing, unreadable or oversized file
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: "missing columns: role_id"
+      404:
+        description: The requester belongs to no agency
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: "user does not have agency"
+      409:
+        description: Some emails were registered while the file was processed
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+    """
+    user = get_current_user()
+    if user.agency_id is None:
+      return {"message": "user does not have agency"}, 404
+
+    file = request.files.get('file')
+    if file is None:
+      return {"message": "file is required"}, 400
+    try:
+      rows = read_invite_csv(file.read())
+    except InviteError as error:
+      return {"message": str(error)}, 400
+
+    try:
+      report = invite_users(rows, user.agency_id)
+      db.session.commit()
+    except IntegrityError:
+      db.session.rollback()
+      return {"message": "some emails were registered meanwhile, upload the file again"}, 409
+
+    created = sum(1 for row in report if row["status"] == "created")
+    return {"created": created, "invalid": len(report) - created, "rows": report}, 200
+
+
 
 @auth_pg.route("/v1/user", methods=["GET"])
 @jwt_required()
@@ -473,13 +581,48 @@ def get_users():
   tags:
     - user
   summary: Retrieve users based on authorization
-  description: Returns a list of users. For superadmins, returns all users; for other users, returns only users from their agency.
+  description: Returns a page of users. For superadmins, returns users of every agency; for other users, returns only users from their agency. Filter with agency_id, role_id, is_active and is_verified.
   operationId: getUsers
   security:
     - bearerAuth: []
+  parameters:
+    - name: limit
+      in: query
+      type: integer
+      required: false
+      description: Page size (default 50, at most 200)
+    - name: after
+      in: query
+      type: string
+      required: false
+      description: Opaque cursor from the X-Next-Cursor header of the previous page
+    - name: agency_id
+      in: query
+      type: integer
+      required: false
+      description: Only users of this agency (superadmins; others may only pass their own agency)
+    - name: role_id
+      in: query
+      type: integer
+      required: false
+      description: Only users with this role
+    - name: is_active
+      in: query
+      type: boolean
+      required: false
+      description: Only active (true) or deactivated (false) users
+    - name: is_verified
+      in: query
+      type: boolean
+      required: false
+      description: Only verified (true) or unverified (false) users
   responses:
     200:
-      description: List of users retrieved successfully
+      description: Page of users retrieved successfully, oldest first
+      headers:
+        X-Next-Cursor:
+          type: string
+          description: Cursor of the next page, absent on the last page
       schema:
         type: array
         items:
@@ -511,6 +654,14 @@ def get_users():
                   type: string
                   description: Agency name
                 # Additional agency properties would be listed here
+    400:
+      description: Invalid limit, cursor or filter
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            description: Error message
     401:
       description: Unauthorized - Invalid or expired token
       schema:
@@ -527,6 +678,14 @@ def get_users():
           message:
             type: string
             description: Error message
+    404:
+      description: The requester belongs to no agency
+      schema:
+        type: object
+        properties:
+          message:
+            type: string
+            description: Error message
     500:
       description: Server error
       schema:
@@ -536,29 +695,43 @@ def get_users():
             type: string
             description: Error message
   """
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
   
-  user = User.query.filter_by(id=payload['user_id'], is_active=True).first()
-  agency = Agency.query.filter_by(id=user.agency_id).first()
-  if agency is None and user.user_type == UserType.SUPERADMIN:
-    users = User.query.all()
+  user = get_current_user()
+  query = project(User, USER_LISTING_COLUMNS)
+  agency_id = get_int_arg('agency_id')
+  if user.user_type == UserType.SUPERADMIN and user.agency_id is None:
+    if agency_id is not None:
+      query = query.filter(User.agency_id == agency_id)
+  elif user.agency_id is None:
+    return {"message": "agency not found"}, 404
+  elif agency_id is not None and agency_id != user.agency_id:
+    return {"message": "you can only list the users of your agency"}, 403
   else:
-    users = User.query.filter_by(agency_id=agency.id).all()
+    query = query.filter(User.agency_id == user.agency_id)
+  
+  role_id = get_int_arg('role_id')
+  if role_id is not None:
+    query = query.filter(User.role_id == role_id)
+  for flag in ('is_active', 'is_verified'):
+    value = get_bool_arg(flag)
+    if value is not None:
+      query = query.filter(getattr(User, flag) == value)
+  
+  users, next_cursor = paginate(query, [User.id])
   
+  users_details = get_users_details(users)
+  # each agency is serialized once, however many of its users are on the page
+  agencies = project(Agency, AGENCY_LISTING_COLUMNS).filter(
+    Agency.id.in_({user.agency_id for user in users if user.agency_id is not None})
+  ).all()
+  agencies_details = get_agencies_details(agencies) if agencies else {}
   users_list = []
-  for user  in users:
-    
-    user_details = get_user_details(user)
-    if agency is not None:
-      agency_details = get_agency_details(agency)
-      user_details['agency'] = agency_details
-    else:
-      user_details['agency'] = None
-      
+  for user in users:
+    user_details = users_details[user.id]
+    user_details['agency'] = agencies_details.get(user.agency_id)
     users_list.append(user_details)
     
-  return users_list, 200
+  return users_list, 200, page_headers(next_cursor)
 
 
 
@@ -649,10 +822,8 @@ def get_user_by_id(user_id):
             type: string
             description: Error message
   """
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
 
-  owner = User.query.filter_by(id=payload['user_id'], is_active=True).first()
+  owner = get_current_user()
   user = User.query.filter_by(id=user_id, is_active=True).first()
   if owner and owner.user_type != UserType.SUPERADMIN:
     if user is None:
@@ -796,6 +967,7 @@ def assign_permissions_to_role(role_id):
           
       db.session.add_all(new_role_permissions)
       db.session.commit()
+      invalidate_role_permissions()
       
       return jsonify({
           "message": f"Successfully assigned {len(permission_ids)} permissions to role {role.name}",
@@ -881,16 +1053,7 @@ def get_role_permissions(role_id):
             return jsonify({"error": "Role not found"}), 404
             
         # Get all role permissions
-        role_permissions = RolePermission.query.filter_by(role_id=role_id).all()
-        permission_ids = [rp.permission_id for rp in role_permissions]
-        
-        # Get permission details
-        permissions = Permission.query.filter(Permission.id.in_(permission_ids)).all()
-        permission_data = [{
-            "id": p.id,
-            "type": p.type,
-            "name": p.name
-        } for p in permissions]
+        permission_data = get_token_permissions(get_cached_role_permissions_map([role_id])[role_id])
         
         return jsonify({
             "role": {
@@ -989,6 +1152,20 @@ def log_in():
                 message:
                   type: string
                   example: "wrong email"
+      429:
+        description: Too many login attempts from this address or for this account
+        headers:
+          Retry-After:
+            type: integer
+            description: Seconds to wait before trying again
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+                  example: "too many login attempts, try again later"
     """
     try:
         data = request.json
@@ -998,9 +1175,16 @@ def log_in():
     if "email" not in data or data["email"] == "":
         return {"message": "email is required"}, 400
 
+    if not isinstance(data["email"], str):
+        return {"message": "email must be a string"}, 400
+
     if "password" not in data or data["password"] == "":
         return {"message": "password is required"}, 400
 
+    retry_after = throttle_login(data["email"], request.remote_addr)
+    if retry_after:
+        return {"message": "too many login attempts, try again later"}, 429, {"Retry-After": str(retry_after)}
+
     user = User.query.filter_by(email=data["email"], is_active=True).first()
     if user is None:
         return {"message": "wrong email"}, 404
@@ -1008,37 +1192,24 @@ def log_in():
     if not user.check_password(data["password"]):
         return {"message": "wrong password"}, 400
 
+    # hashes made with an older method or cost are upgraded while the password is at hand
+    if needs_rehash(user.password_hash):
+        user.password_hash = set_password(data["password"])
+        db.session.commit()
+
     # additional_claims = {"user_type": user.user_type.value, "email": user.email}
 
-    role = Role.query.filter_by(id=user.role_id).first()
-    if role is None:
+    # users.role_id references roles, so a set role_id is a role that exists
+    if user.role_id is None:
         return {"message": "user does not have role"}, 400
 
-    role_permissions = RolePermission.query.filter_by(role_id=role.id).all()
-    permission_ids = [
-        role_permission.permission_id for role_permission in role_permissions
-    ]
-
-    permissions_list = []
-    for permission_id in permission_ids:
-        permission = Permission.query.filter_by(id=permission_id).first()
-
-        permissions_list.append(
-            {"id": permission.id, "type": permission.type, "name": permission.name}
-        )
-
     access_token = create_access_token(
-        identity=json.dumps({"user_id": str(user.id)
-                             , "permissions": permissions_list
-                             }),
-        # additional_claims=additional_claims,
+        identity=get_token_identity(user),
+        additional_claims=get_token_claims(user),
     )
 
     refresh_token = create_refresh_token(
-        identity=json.dumps({"user_id": str(user.id)
-                             , "permissions": permissions_list
-                             }),
-        # additional_claims=additional_claims,
+        identity=get_token_identity(user),
     )
 
     addresses = get_address_details(user.id, is_primary=True)
@@ -1063,21 +1234,125 @@ def log_in():
 @auth_pg.route("/v1/refresh", methods=["POST"])
 @jwt_required(refresh=True)
 def refresh_token():
-    payload = get_jwt_identity()
-    payload = json.loads(payload)
-    user = User.query.filter_by(id=payload["user_id"], is_active=True).first()
+    user = get_current_user()
     if user is None:
       return {"message": "user not found"}, 404
     
-    additional_claims = {"user_type": user.user_type, "email": user.email}
-
+    # the permissions are read again, so a refreshed token follows role changes
     new_access_token = create_access_token(
-        identity=payload["user_id"], additional_claims=additional_claims
+        identity=get_token_identity(user), additional_claims=get_token_claims(user)
     )
 
     return {"access_token": new_access_token}, 200
 
 
+@auth_pg.route("/v1/logout", methods=["POST"])
+@jwt_required(verify_type=False)
+def log_out():
+    """
+    Log out
+    ---
+    tags:
+      - Authentication
+    summary: Revoke the presented token, and optionally the session's refresh token
+    description: |
+      Revoked tokens are rejected by every worker within a few seconds, until they expire.
+      Send the access token as bearer and the refresh token in the body to end the session.
+    parameters:
+      - in: body
+        name: body
+        required: false
+        schema:
+          type: object
+          properties:
+            refresh_token:
+              type: string
+              description: Refresh token to revoke along with the bearer token
+    responses:
+      200:
+        description: Tokens revoked
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                message:
+                  type: string
+                  example: "logged out"
+      400:
+        description: The refresh token is invalid or belongs to another user
+    security:
+      - bearerAuth: []
+    """
+    tokens = [get_jwt()]
+
+    data = request.get_json(silent=True) or {}
+    if data.get("refresh_token"):
+        try:
+            refresh_claims = decode_token(data["refresh_token"], allow_expired=True)
+        except Exception:
+            return {"message": "invalid refresh token"}, 400
+        if refresh_claims["sub"] != tokens[0]["sub"]:
+            return {"message": "invalid refresh token"}, 400
+        tokens.append(refresh_claims)
+
+    for claims in tokens:
+        revocation_list.revoke(claims["jti"], claims["exp"])
+
+    return {"message": "logged out"}, 200
+
+
+@auth_pg.cli.command("purge-revoked-tokens")
+def purge_revoked_tokens_command():
+    """Delete revoked tokens that have expired since: flask auth purge-revoked-tokens"""
+    print(f"purged {revocation_list.purge()} revoked tokens")
+
+
+@auth_pg.route("/v1/login/throttle", methods=["GET"])
+@jwt_required()
+def get_login_throttle():
+    """
+    Login throttle counters
+    ---
+    tags:
+      - Authentication
+    summary: Budgets of the login throttles and the attempts they allowed and rejected
+    description: Counters are kept per worker since it started. Only super admins may read them.
+    responses:
+      200:
+        description: Throttle settings and counters, per client address and per account
+        content:
+          application/json:
+            schema:
+              type: object
+              properties:
+                store:
+                  type: string
+                  example: memory
+                ip:
+                  type: object
+                  properties:
+                    capacity:
+                      type: integer
+                    per_minute:
+                      type: number
+                    allowed:
+                      type: integer
+                    rejected:
+                      type: integer
+                account:
+                  type: object
+      403:
+        description: The caller is not a super admin
+    security:
+      - bearerAuth: []
+    """
+    if get_current_user().user_type != UserType.SUPERADMIN:
+        return {"message": "you don't have permission to read the login throttle"}, 403
+
+    return get_login_throttle_stats(), 200
+
+
 @auth_pg.route("/v1/request-otp", methods=["POST"])
 def request_otp():
     """
@@ -1132,19 +1407,11 @@ def request_otp():
         # Don't reveal if email exists to prevent enumeration
         return {"message": "If an account exists, an OTP will be sent"}, 200
 
-    # Delete any existing unused OTP tokens
-    OTPResetToken.query.filter_by(user_id=user.id, is_used=False).delete()
-
-    # Generate OTP
-    otp = generate_otp()
-
-    # Create new OTP token (valid for 15 minutes)
-    otp_token = OTPResetToken(
-        user_id=user.id, otp=otp, expires_at=datetime.utcnow() + timedelta(minutes=15)
-    )
-
-    db.session.add(otp_token)
-    db.session.commit()
+    # Replace any unused OTP with a new one (valid for 15 minutes)
+    otp = issue_otp(user)
+    if otp is None:
+        # over the hourly limit, answered like an unknown email
+        return {"message": "If an account exists, an OTP will be sent"}, 200
 
     # TODO: Send OTP via email or SMS
     # send_otp_to_user(user.email, otp)
@@ -1152,6 +1419,12 @@ def request_otp():
     return {"message": "OTP sent successfully", "otp": otp}, 200
 
 
+@auth_pg.cli.command("purge-otp-tokens")
+def purge_otp_tokens_command():
+    """Delete used and expired OTP tokens, e.g. from cron: flask auth purge-otp-tokens"""
+    print(f"purged {purge_otp_tokens()} OTP tokens")
+
+
 @auth_pg.route("/v1/verify-otp", methods=["POST"])
 def verify_otp():
     """
@@ -1223,9 +1496,7 @@ def verify_otp():
         return {"error": "User not found"}, 404
 
     # Find valid, unused OTP token
-    otp_token = OTPResetToken.query.filter_by(
-        user_id=user.id, otp=otp, is_used=False
-    ).first()
+    otp_token = find_otp_token(user, otp)
 
     if not otp_token:
         return {"error": "Invalid OTP"}, 400
@@ -1425,27 +1696,15 @@ def get_roles():
     """
     try:
         roles = Role.query.all()
+        permissions_map = get_cached_role_permissions_map(role.id for role in roles)
         
         roles_list = []
         for role in roles:
-          permissions_list = []
-          role_permissions = RolePermission.query.filter_by(role_id=role.id).all()
-          for role_permission in role_permissions:
-            permission = Permission.query.filter_by(id=role_permission.permission_id).first()
-            
-            permissions_list.append({
-              "id": permission.id,
-              "type": permission.type,
-              "name": permission.name,
-              "created_at": permission.created_at,
-              "updated_at": permission.updated_at,
-            })
-          
           roles_list.append(
             {
               "id": role.id,
               "name": role.name,
-              "permission": permissions_list,
+              "permission": permissions_map[role.id],
               "created_at": role.created_at.isoformat(),
               "updated_at": role.updated_at.isoformat(),
             }
@@ -1543,17 +1802,7 @@ def get_role_by_id(role_id):
       if role is None:
           return {"message": "role not found"}, 404
 
-      permissions_list = []
-      role_permissions = RolePermission.query.filter_by(role_id=role.id).all()
-      for role_permission in role_permissions:
-        permission = Permission.query.filter_by(id=role_permission.permission_id).first()
-        permissions_list.append({
-          "id": permission.id,
-          "type": permission.type,
-          "name": permission.name,
-          "created_at": permission.created_at,
-          "updated_at": permission.updated_at,
-        })
+      permissions_list = get_cached_role_permissions_map([role.id])[role.id]
         
       return jsonify(
           {
@@ -1707,25 +1956,13 @@ def assign_user_role(role_id, user_id):
   if role is None:
       return {"message": "role not found"}, 404
 
-  permissions_list = []
-  role_permissions = RolePermission.query.filter_by(role_id=role.id).all()
-  
-  for role_permission in role_permissions:
-    permission = Permission.query.filter_by(id=role_permission.permission_id).first()
-    
-    permissions_list.append({
-      "id": permission.id,
-      "type": permission.type,
-      "name": permission.name,
-      "created_at": permission.created_at,
-      "updated_at": permission.updated_at,
-    })
+  permissions_list = get_cached_role_permissions_map([role.id])[role.id]
   
   try:
       user.role_id = role.id
       db.session.commit()
 
-      agency = agency.query.filter_by(id=user.agency_id).first()
+      agency = Agency.query.filter_by(id=user.agency_id).first()
       if agency is None:
           agency_json = None
       else:
@@ -1809,9 +2046,7 @@ def get_user_permissions():
       - bearerAuth: []  # Assuming JWT authentication is required for this endpoint
     """
     try:
-        payload = get_jwt_identity()
-        payload = json.loads(payload)
-        user = User.query.filter_by(id=payload["user_id"]).first()
+        user = get_current_user()
         if user is None:
             return {"message": "user not found"}, 404
 
@@ -1970,9 +2205,7 @@ def get_permission_by_id(permission_id):
       - bearerAuth: []  # Assuming JWT authentication is required for this endpoint
     """
     try:
-        payload = get_jwt_identity()
-        payload = json.loads(payload)
-        user = User.query.filter_by(id=payload["user_id"]).first()
+        user = get_current_user()
         if user is None:
             return {"message": "user not found"}, 404
 
@@ -2027,6 +2260,9 @@ def sync_permission_api():
               type: string
               description: Error message describing the issue
     """
-    seed_permissions()
-    seed_roles()
+    created = seed_permissions() + seed_roles()
+    db.session.commit()
+    # a re-run adds nothing, and leaves every worker's permission caches alone
+    if created:
+        invalidate_role_permissions()
     return "Done", 200
@@ -1,13 +1,23 @@
-from typing import Dict
+from typing import Dict, Iterable, Optional, Set
 from app.blueprints.agency.methods import get_agency_details
 from app.blueprints.agency.models import Agency
 from app.blueprints.category.models import Category
+from app.utils.fields import get_effective_expand, select_fields
+from app.utils.loader import get_loader
 
-def get_category_json(category: Category)-> Dict:
-    agency = Agency.query.filter_by(id=category.agency_id).first()
-    agency_details = get_agency_details(agency)
-    return {
+CATEGORY_EXPANSIONS = ('agency',)
+
+
+def get_category_json(
+    category: Category,
+    fields: Optional[Set[str]] = None,
+    expand: Iterable[str] = CATEGORY_EXPANSIONS,
+)-> Dict:
+    payload = {
         "id": category.id,
         "name": category.name,
-        "agency": agency_details
-    }
\ No newline at end of file
+    }
+    if 'agency' in get_effective_expand(expand, fields):
+        agency = get_loader().load(Agency, category.agency_id)
+        payload["agency"] = get_agency_details(agency)
+    return select_fields(payload, fields)
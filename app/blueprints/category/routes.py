@@ -2,10 +2,12 @@ import json
 from app.blueprints.auth.models import User
 from flask import Blueprint, request
 from app.blueprints.category.models import Category, db
-from app.blueprints.category.methods import get_category_json
+from app.blueprints.category.methods import CATEGORY_EXPANSIONS, get_category_json
+from app.utils.fields import get_expand, get_fields
+from app.utils.pagination import page_headers, paginate
 from flask_jwt_extended import (
     jwt_required,
-    get_jwt_identity
+    get_current_user
 )
 
 
@@ -105,10 +107,7 @@ def add_category():
     except:
         return {"message":"can't receive the request"}, 400
     
-    payload = get_jwt_identity()
-    payload = json.loads(payload)
-    
-    user = User.query.filter_by(id=payload['user_id']).first()
+    user = get_current_user()
     if 'name' not in data:
         return {"message": "name is required"}, 400
     
@@ -131,9 +130,36 @@ def get_categories():
     - Categories
   security:
     - jwt: []
+  parameters:
+    - name: limit
+      in: query
+      type: integer
+      required: false
+      description: Page size (default 50, at most 200)
+    - name: after
+      in: query
+      type: string
+      required: false
+      description: Opaque cursor from the X-Next-Cursor header of the previous page
+    - name: fields
+      in: query
+      type: string
+      required: false
+      description: Comma separated top-level fields to return (all when omitted)
+      example: "id,name"
+    - name: expand
+      in: query
+      type: string
+      required: false
+      description: Comma separated relations to embed, among agency (defaults to agency; pass an empty value to embed none)
+      example: "agency"
   responses:
     200:
-      description: List of categories
+      description: Page of categories, oldest first
+      headers:
+        X-Next-Cursor:
+          type: string
+          description: Cursor of the next page, absent on the last page
       schema:
         type: array
         items:
@@ -154,18 +180,20 @@ def get_categories():
     401:
       description: Unauthorized, invalid or expired token
   """
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
-  user = User.query.filter_by(id=payload['user_id']).first()
-  categories = Category.query.filter_by(agency_id=user.agency_id).all()
+  user = get_current_user()
+  fields = get_fields()
+  expand = get_expand(CATEGORY_EXPANSIONS, CATEGORY_EXPANSIONS)
+  categories, next_cursor = paginate(
+    Category.query.filter_by(agency_id=user.agency_id), [Category.id]
+  )
   
   category_list = []
   for category in categories:
     category_list.append(
-      get_category_json(category)
+      get_category_json(category, fields, expand)
       )
     
-  return category_list, 200
+  return category_list, 200, page_headers(next_cursor)
 
 
 @category_pg.route('/v1/category/<int:category_id>', methods=['GET'])
@@ -184,6 +212,18 @@ def get_category(category_id):
       type: integer
       required: true
       description: ID of the category to retrieve
+    - name: fields
+      in: query
+      type: string
+      required: false
+      description: Comma separated top-level fields to return (all when omitted)
+      example: "id,name"
+    - name: expand
+      in: query
+      type: string
+      required: false
+      description: Comma separated relations to embed, among agency (defaults to agency; pass an empty value to embed none)
+      example: "agency"
   responses:
     200:
       description: Category details
@@ -207,11 +247,9 @@ def get_category(category_id):
     404:
       description: Category not found
   """
-  payload = get_jwt_identity()
-  payload = json.loads(payload)
-  user = User.query.filter_by(id=payload['user_id']).first()
+  user = get_current_user()
   category = Category.query.filter_by(id=category_id, agency_id=user.agency_id).first()
   
-  return get_category_json(category), 200
+  return get_category_json(category, get_fields(), get_expand(CATEGORY_EXPANSIONS, CATEGORY_EXPANSIONS)), 200
 
 
@@ -1,11 +1,18 @@
 import uuid
 
-from app.blueprints.agency.methods import get_agency_details
+from sqlalchemy import func, select
+
+from app.blueprints.address.methods import geo_snapshot
+from app.blueprints.agency.methods import get_agencies_details
 from app.blueprints.agency.models import Agency
-from app.blueprints.auth.methods import get_user_details
+from app.blueprints.auth.methods import get_users_details
 from app.blueprints.auth.models import User
 from app.blueprints.category.methods import get_category_json
 from app.blueprints.category.models import Category
+from app.blueprints.product.models import Product
+from app.utils.etag import get_version
+from app.utils.fields import get_effective_expand, select_fields
+from app.utils.loader import get_loader
 
 
 def generate_random_filename(extension=""):
@@ -14,21 +21,96 @@ def generate_random_filename(extension=""):
 
 
 
-def get_product_details(product):
-    agency = Agency.query.filter_by(id=product.agency_id).first()
-    user = User.query.filter_by(id=product.created_by).first()
-    # category = Category.query.filter_by(id=product.category_id).first()
+PRODUCT_EXPANSIONS = ('agency', 'created_by', 'category')
+PRODUCT_DEFAULT_EXPANSIONS = ('agency', 'created_by')
+# columns read by listings, which load rows of these rather than Product entities
+PRODUCT_LISTING_COLUMNS = (
+    'id', 'name', 'price', 'image_url', 'agency_id', 'created_by', 'category_id', 'created_at', 'updated_at',
+)
+
+
+def get_product_listing_columns(fields=None):
+    # the description text is the bulk of a row, it is only read when it is returned
+    if fields is None or 'description' in fields:
+        return PRODUCT_LISTING_COLUMNS + ('description',)
+    return PRODUCT_LISTING_COLUMNS
+
+
+def get_agency_products_version(agency_id):
+    """
+    Version of an agency's visible products and of everything embedded in their payloads
+    (the agency, the creators and the categories) in one query, and the geo version.
+    """
+    criteria = [Product.agency_id == agency_id, Product.is_visible == True]
+    # subqueries are never correlated with the outer products query
+    creator_ids = select(Product.created_by).where(*criteria).correlate(None)
+    category_ids = select(Product.category_id).where(*criteria).correlate(None)
+    return get_version(
+        func.count(Product.id),
+        func.max(Product.updated_at),
+        select(Agency.updated_at).where(Agency.id == agency_id).correlate(None).scalar_subquery(),
+        select(func.max(User.updated_at)).where(User.id.in_(creator_ids)).correlate(None).scalar_subquery(),
+        select(func.max(Category.updated_at)).where(Category.id.in_(category_ids)).correlate(None).scalar_subquery(),
+        criteria=criteria,
+    ) + (geo_snapshot.get().version,)
+
+
+def get_product_details(product, fields=None, expand=PRODUCT_DEFAULT_EXPANSIONS):
+    return get_products_details([product], fields, expand)[0]
+
+
+def get_products_details(products, fields=None, expand=PRODUCT_DEFAULT_EXPANSIONS):
+    """
+    Serialize a product listing with a fixed number of queries: one IN query each for
+    agencies, users and every table nested in their payloads, whatever the listing size.
+    Only the relations in `expand` (and in `fields`, when given) are loaded.
+    """
+    if not products:
+        return []
+
+    expand = get_effective_expand(expand, fields)
+    loader = get_loader()
+    relations = {relation: {} for relation in expand}
+
+    if 'agency' in expand:
+        agencies = [agency for agency in loader.load_many(Agency, {product.agency_id for product in products}) if agency]
+        relations['agency'] = get_agencies_details(agencies)
+
+    if 'created_by' in expand:
+        users = [user for user in loader.load_many(User, {product.created_by for product in products}) if user]
+        relations['created_by'] = get_users_details(users)
+
+    if 'category' in expand:
+        categories = [category for category in loader.load_many(Category, {product.category_id for product in products}) if category]
+        loader.prime(Agency, {category.agency_id for category in categories})
+        relations['category'] = {category.id: get_category_json(category) for category in categories}
+
+    foreign_keys = {'agency': 'agency_id', 'created_by': 'created_by', 'category': 'category_id'}
+    return [
+        serialize_product(
+            product,
+            fields,
+            **{
+                relation: details.get(getattr(product, foreign_keys[relation]))
+                for relation, details in relations.items()
+            },
+        )
+        for product in products
+    ]
 
 
-    return {
+def serialize_product(product, fields=None, **relations):
+    payload = {
         "id": product.id,
         "name": product.name,
-        "description": product.description,
+    }
+    if fields is None or "description" in fields:
+        payload["description"] = product.description
+    payload.update({
         "price": product.price,
         "image_url": product.image_url,
         "created_at": product.created_at,
         "updated_at": product.updated_at,
-        "agency": get_agency_details(agency),
-        "created_by": get_user_details(user),
-        # "category": get_category_json(category)
-    }
\ No newline at end of file
+    })
+    payload.update(relations)
+    return select_fields(payload, fields)
@@ -1,16 +1,27 @@
 
-import json
 from app.blueprints.auth.models import User
 from app.blueprints.category.models import Category
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import (
     jwt_required,
-    get_jwt_identity,
+    get_current_user,
 )
-from app.blueprints.product.methods import get_product_details
+from app.blueprints.product.methods import (
+    PRODUCT_DEFAULT_EXPANSIONS,
+    PRODUCT_EXPANSIONS,
+    get_agency_products_version,
+    get_product_listing_columns,
+    get_product_details,
+    get_products_details,
+)
+from app.utils.etag import check_etag, etag_headers
+from app.utils.fields import get_expand, get_fields
+from app.utils.streaming import stream_json_array, wants_stream
 from db.database import db
 from app.blueprints.agency.models import Agency
 from app.blueprints.product.models import Product
+from app.utils.pagination import PaginationError, get_page_args, page_headers, paginate
+from app.utils.read_models import project
 
 product_bp = Blueprint("product", __name__)
 
@@ -59,9 +70,40 @@ def manage_products():
         description: URL to product image
         default: ""
         example: "https://example.com/images/product.jpg"
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated top-level fields to return (all when omitted)
+        example: "id,name,price,image_url"
+      - name: expand
+        in: query
+        type: string
+        required: false
+        description: Comma separated relations to embed, among agency, created_by, category (defaults to agency,created_by; pass an empty value to embed none)
+        example: "agency,created_by"
+      - name: stream
+        in: query
+        type: boolean
+        required: false
+        description: Stream every matching product as one JSON array instead of returning a page
     responses:
       200:
-        description: Product created successfully or list of all products
+        description: Product created successfully or a page of the agency's products (GET, oldest first)
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
         schema:
           type: object
           properties:
@@ -95,9 +137,7 @@ def manage_products():
       401:
         description: Unauthorized, invalid or expired token
     """
-    payload = get_jwt_identity()
-    payload = json.loads(payload)
-    user = User.query.filter_by(id=payload['user_id']).first()
+    user = get_current_user()
     agency = Agency.query.filter_by(id=user.agency_id).first()
     if agency is None:
         return {"message": "agency not found"}, 404
@@ -127,13 +167,18 @@ def manage_products():
         
         return get_product_details(new_product), 200
     
-    products = Product.query.filter_by(agency_id=user.agency_id, is_visible=True).all()
+    fields = get_fields()
+    expand = get_expand(PRODUCT_EXPANSIONS, PRODUCT_DEFAULT_EXPANSIONS)
+    query = project(Product, get_product_listing_columns(fields)).filter_by(agency_id=user.agency_id, is_visible=True)
+    if wants_stream():
+        return stream_json_array(
+            query.order_by(Product.id),
+            lambda products: get_products_details(products, fields, expand),
+        )
+    
+    products, next_cursor = paginate(query, [Product.id])
     
-    return [
-        {
-            get_product_details(product)
-        } for product in products
-    ], 200
+    return get_products_details(products, fields, expand), 200, page_headers(next_cursor)
 
 
 @product_bp.route('/v1/product/<int:product_id>', methods=['GET'])
@@ -150,6 +195,18 @@ def get_product(product_id):
         required: true
         description: ID of the product to retrieve
         example: 1
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated top-level fields to return (all when omitted)
+        example: "id,name,price,image_url"
+      - name: expand
+        in: query
+        type: string
+        required: false
+        description: Comma separated relations to embed, among agency, created_by, category (defaults to agency,created_by; pass an empty value to embed none)
+        example: "agency,created_by"
     responses:
       200:
         description: Product details
@@ -186,12 +243,14 @@ def get_product(product_id):
       500:
         description: Server error
     """
+    fields = get_fields()
+    expand = get_expand(PRODUCT_EXPANSIONS, PRODUCT_DEFAULT_EXPANSIONS)
     try:
         product = Product.query.filter_by(id=product_id, is_visible=True).first()
         if not product:
             return jsonify({"message": "Product not found"}), 404
         
-        return get_product_details(product), 200
+        return get_product_details(product, fields, expand), 200
         
     except Exception as e:
         return jsonify({"message": str(e)}), 500
@@ -212,9 +271,45 @@ def get_products_by_agency(agency_id):
         required: true
         description: ID of the agency whose products to retrieve
         example: 1
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated top-level fields to return (all when omitted)
+        example: "id,name,price,image_url"
+      - name: expand
+        in: query
+        type: string
+        required: false
+        description: Comma separated relations to embed, among agency, created_by, category (defaults to agency,created_by; pass an empty value to embed none)
+        example: "agency,created_by"
+      - name: stream
+        in: query
+        type: boolean
+        required: false
+        description: Stream every matching product as one JSON array instead of returning a page
     responses:
+      304:
+        description: Not modified since the ETag given in If-None-Match
       200:
-        description: List of products for the specified agency
+        description: Page of products (or all of them when streamed) for the specified agency, oldest first
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
+          ETag:
+            type: string
+            description: Weak validator of the listing, send it back in If-None-Match
         schema:
           type: array
           items:
@@ -248,15 +343,32 @@ def get_products_by_agency(agency_id):
       500:
         description: Server error
     """
+    limit, after = get_page_args()
+    fields = get_fields()
+    expand = get_expand(PRODUCT_EXPANSIONS, PRODUCT_DEFAULT_EXPANSIONS)
     try:
-        products = Product.query.filter_by(agency_id=agency_id, is_visible=True).all()
-        products_list = []
-        for product in products:
-            products_list.append(
-                get_product_details(product)
+        etag, not_modified = check_etag(get_agency_products_version(agency_id))
+        if not_modified:
+            return not_modified
+        
+        query = project(Product, get_product_listing_columns(fields)).filter_by(agency_id=agency_id, is_visible=True)
+        if wants_stream():
+            response = stream_json_array(
+                query.order_by(Product.id),
+                lambda products: get_products_details(products, fields, expand),
             )
-        return products_list, 200
+            response.set_etag(etag, weak=True)
+            return response
+        
+        products, next_cursor = paginate(query, [Product.id], limit, after)
+        return (
+            get_products_details(products, fields, expand),
+            200,
+            {**page_headers(next_cursor), **etag_headers(etag)},
+        )
         
+    except PaginationError:
+        raise
     except Exception as e:
         return jsonify({"message": str(e)}), 500
     
@@ -5,19 +5,46 @@ import os
 import uuid
 import qrcode
 import json
+from collections import namedtuple
+from datetime import datetime
 from app.blueprints.agency.methods import get_agency_details
 from app.blueprints.agency.models import Agency
+from app.blueprints.qrcode.models import QRCode
+from app.blueprints.qrcode.routing import get_compiled_routes, get_device_class
+from app.utils.cache import TTLCache
+from app.utils.fields import select_fields
+from app.utils.loader import get_loader
 from config.config import Config
+from db.database import db
 from werkzeug.utils import secure_filename
 
+
+# Maximum number of codes accepted by one batch resolve call
+RESOLVE_MAX_CODES = 5000
+
+QRResolution = namedtuple(
+    'QRResolution',
+    ['code', 'qr_id', 'agency_id', 'expire_at', 'agency_exists', 'destination', 'routing_rules'],
+)
+
+# Shared by redirect_qr and the batch resolve endpoint, keyed by the scan UUID.
+# Unknown codes are cached too (qr_id is None) so repeated bad scans stay cheap.
+qr_resolution_cache = TTLCache(ttl=60, maxsize=100000)
+
+# columns read by listings, which load rows of these rather than QRCode entities
+QR_LISTING_COLUMNS = (
+    'id', 'name', 'agency_id', 'qrcode_url', 'content', 'destination', 'expire_at', 'created_at', 'updated_at',
+)
+
 def get_qr_details(qr_code):
-    agency = Agency.query.filter_by(id=qr_code.agency_id).first()
+    agency = get_loader().load(Agency, qr_code.agency_id)
     agency_details = get_agency_details(agency)
     
     return {
         "id": qr_code.id,
         "name": qr_code.name,
         "qrcode_url": qr_code.qrcode_url,
+        "destination": qr_code.destination,
         "expire_at": qr_code.expire_at,
         "created_at": qr_code.created_at,
         "updated_at": qr_code.updated_at,
@@ -25,6 +52,21 @@ def get_qr_details(qr_code):
     }
     
     
+def get_qr_listing_details(qr, qr_base_url, fields=None):
+    return select_fields({
+        "id": qr.id,
+        "name": qr.name,
+        "agency_id": qr.agency_id,
+        "qrcode_url": qr.qrcode_url,
+        "scanner_url": f"{qr_base_url}/api/qr/{qr.content}",
+        "destination": qr.destination,
+        "expire_at": qr.expire_at.isoformat() if qr.expire_at else None,
+        "is_expired": qr.expire_at and qr.expire_at < datetime.now(),
+        "created_at": qr.created_at,
+        "updated_at": qr.updated_at
+    }, fields)
+    
+    
 def generate_qr_code(content, agency_id, qr_name):
     # Create QR code instance
     qr = qrcode.QRCode(
@@ -50,4 +92,71 @@ def generate_qr_code(content, agency_id, qr_name):
     img.save(img_path)
     
     # Return the relative URL to the image
-    return f'{Config.IMAGE_ICONS_GLOBAL_URL}/{filename}'
\ No newline at end of file
+    return f'{Config.IMAGE_ICONS_GLOBAL_URL}/{filename}'
+
+
+def resolve_qr_codes(codes):
+    """Resolve scan UUIDs to QRResolution entries with at most one IN query."""
+    resolved = qr_resolution_cache.get_many(codes)
+    missing = [code for code in dict.fromkeys(codes) if code not in resolved]
+    if missing:
+        rows = (
+            db.session.query(
+                QRCode.content,
+                QRCode.id,
+                QRCode.agency_id,
+                QRCode.expire_at,
+                Agency.id,
+                QRCode.destination,
+                QRCode.routing_rules,
+            )
+            .outerjoin(Agency, Agency.id == QRCode.agency_id)
+            .filter(QRCode.content.in_(missing))
+            .all()
+        )
+        fetched = {
+            content: QRResolution(
+                content, qr_id, agency_id, expire_at, found_agency_id is not None, destination, routing_rules
+            )
+            for content, qr_id, agency_id, expire_at, found_agency_id, destination, routing_rules in rows
+        }
+        for code in missing:
+            fetched.setdefault(code, QRResolution(code, None, None, None, False, None, None))
+        qr_resolution_cache.set_many(fetched)
+        resolved.update(fetched)
+    return resolved
+
+
+def resolve_qr_code(code):
+    return resolve_qr_codes([code])[code]
+
+
+def invalidate_qr_resolution(code):
+    qr_resolution_cache.delete(code)
+
+
+def get_resolution_status(resolution, now=None):
+    if resolution.qr_id is None:
+        return "not_found"
+    if resolution.expire_at and resolution.expire_at < (now or datetime.now()):
+        return "expired"
+    if not resolution.agency_exists:
+        return "agency_not_found"
+    return "active"
+
+
+def build_redirect_target(resolution, host_url, user_agent=None, when=None):
+    """
+    Pick where a scan goes: the code's routing rules when one matches, then its stored
+    destination, then the agency product page used before destinations were stored.
+    Without a user agent (batch resolve) the rules are skipped.
+    """
+    if user_agent is not None:
+        routes = get_compiled_routes(resolution.routing_rules)
+        if routes is not None:
+            target = routes.choose(get_device_class(user_agent), when)
+            if target:
+                return target
+    if resolution.destination:
+        return resolution.destination
+    return f"{host_url.rstrip('/')}/api/v1/product/agency/{resolution.agency_id}"
@@ -19,9 +19,11 @@ class QRCode(db.Model):
     __tablename__ = 'qr_code'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50))
-    content = db.Column(db.String)
+    content = db.Column(db.String, index=True)
     agency_id = db.Column(db.Integer, ForeignKey('agencies.id'))
     qrcode_url = db.Column(db.String(200))
+    destination = db.Column(db.String)
+    routing_rules = db.Column(db.Text)
     expire_at = db.Column(db.DateTime, default=default_expire_at)
     created_at = db.Column(db.DateTime, default=func.now())
     updated_at = db.Column(db.DateTime, default=func.now(), onupdate=func.now())
@@ -81,3 +83,16 @@ class QRCode(db.Model):
 
 
 
+class QRScanSketch(db.Model):
+    """HyperLogLog registers of the distinct scanners of one QR code on one (UTC) day."""
+    __tablename__ = 'qr_scan_sketch'
+    __table_args__ = (
+        db.UniqueConstraint('qr_code_id', 'day', name='uq_qr_scan_sketch_code_day'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    qr_code_id = db.Column(db.Integer, ForeignKey('qr_code.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    registers = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=func.now())
+    updated_at = db.Column(db.DateTime, default=func.now(), onupdate=func.now())
@@ -6,14 +6,36 @@ from flask import Blueprint, redirect, request, jsonify, url_for
 from app.blueprints.agency.models import Agency
 from app.blueprints.product.methods import get_product_details
 from app.blueprints.product.models import Product
-from app.blueprints.qrcode.methods import generate_qr_code, get_qr_details
+from app.blueprints.qrcode.methods import (
+    QR_LISTING_COLUMNS,
+    RESOLVE_MAX_CODES,
+    build_redirect_target,
+    generate_qr_code,
+    get_qr_details,
+    get_qr_listing_details,
+    get_resolution_status,
+    invalidate_qr_resolution,
+    resolve_qr_code,
+    resolve_qr_codes,
+)
 from app.blueprints.qrcode.models import QRCode, default_expire_at
+from app.utils.fields import get_fields
+from app.utils.pagination import PaginationError, get_page_args, page_headers, paginate
+from app.utils.read_models import project
+from app.utils.streaming import stream_json_array, wants_stream
+from app.blueprints.qrcode.routing import RoutingRulesError, compile_routing_rules, validate_target_url
+from app.blueprints.qrcode.scans import (
+    count_unique_scanners,
+    flush_scan_events,
+    get_scanner_fingerprint,
+    record_scan,
+)
 from db.database import db
 
 
 from flask_jwt_extended import (
     jwt_required,
-    get_jwt_identity,
+    get_current_user,
 )
 
 qrcode_bp = Blueprint("qrcode_bp", __name__)
@@ -52,6 +74,13 @@ def create_qr_code():
               type: string
               description: Optional base URL for QR code endpoint (defaults to host URL)
               example: "https://api.myapp.com"
+            routing_rules:
+              type: object
+              description: |
+                Optional rules overriding the destination per scan. The first rule matching the
+                scanner's device class (desktop, ios, android, mobile), weekday (0 = Monday) and
+                UTC hour window wins, and one of its targets is picked by weight.
+              example: {"rules": [{"devices": ["ios"], "days": [5, 6], "hours": [9, 17], "targets": [{"url": "https://a.example", "weight": 80}, {"url": "https://b.example", "weight": 20}]}]}
     responses:
       201:
         description: QR code created successfully
@@ -75,7 +104,10 @@ def create_qr_code():
               description: URL encoded in the QR code
             redirect_target:
               type: string
-              description: Where users will be redirected after scanning
+              description: Where users will be redirected after scanning, stored as the QR code destination
+            routing_rules:
+              type: object
+              description: Routing rules of the QR code, if any
             expire_at:
               type: string
               format: date-time
@@ -103,10 +135,8 @@ def create_qr_code():
             return jsonify({"error": f"Missing required fields: {', '.join(missing_fields)}"}), 400
             
         # Check if agency exists
-        payload = get_jwt_identity()
-        payload = json.loads(payload)
         
-        user = User.query.filter_by(id=payload['user_id']).first()
+        user = get_current_user()
         
         # Create a unique identifier for this QR code
         qr_uuid = uuid.uuid4().hex
@@ -119,6 +149,17 @@ def create_qr_code():
         
         # Store the redirection target (where users will ultimately end up)
         redirect_target = f"{data['redirect_base_url']}/{user.agency_id}"
+        try:
+            validate_target_url(redirect_target)
+        except RoutingRulesError as e:
+            return jsonify({"error": f"Invalid redirect_base_url: {str(e)}"}), 400
+        
+        routing_rules = data.get('routing_rules')
+        if routing_rules is not None:
+            try:
+                compile_routing_rules(routing_rules)
+            except RoutingRulesError as e:
+                return jsonify({"error": f"Invalid routing_rules: {str(e)}"}), 400
         
         # Generate QR code image
         qrcode_url = generate_qr_code(scanner_url, user.agency_id, data['name'])
@@ -129,6 +170,8 @@ def create_qr_code():
             content=qr_uuid,                # The UUID part that identifies this QR
             agency_id=user.agency_id,
             qrcode_url=qrcode_url,
+            destination=redirect_target,
+            routing_rules=json.dumps(routing_rules) if routing_rules is not None else None,
             expire_at=default_expire_at()
         )
         
@@ -142,6 +185,7 @@ def create_qr_code():
                 "qrcode_url": new_qr.qrcode_url,             # URL to the QR code image
                 "scanner_url": scanner_url,                  # URL encoded in the QR
                 "redirect_target": redirect_target,          # Where users will end up
+                "routing_rules": routing_rules,
                 "expire_at": new_qr.expire_at.isoformat() if new_qr.expire_at else None,
                 "created_at": new_qr.created_at
             }, 201
@@ -151,6 +195,7 @@ def create_qr_code():
         return jsonify({"error": str(e)}), 500
 
 @qrcode_bp.route('/v1/qrcode/<int:qr_id>', methods=['PATCH'])
+@jwt_required()
 def update_qr_code(qr_id):
     """
     Update an existing QR code
@@ -181,6 +226,13 @@ def update_qr_code(qr_id):
               format: date-time
               description: Updated expiration date in ISO format (YYYY-MM-DDTHH:MM:SS), or null to remove expiration
               example: "2025-12-31T23:59:59"
+            destination:
+              type: string
+              description: Updated URL users are redirected to after scanning
+              example: "https://myapp.com/store/1"
+            routing_rules:
+              type: object
+              description: Updated routing rules (same format as on creation), or null to remove them
     responses:
       200:
         description: QR code updated successfully
@@ -199,6 +251,12 @@ def update_qr_code(qr_id):
             qrcode_url:
               type: string
               description: URL to the QR code image
+            destination:
+              type: string
+              description: URL users are redirected to after scanning
+            routing_rules:
+              type: object
+              description: Routing rules of the QR code, if any
             expire_at:
               type: string
               format: date-time
@@ -216,13 +274,14 @@ def update_qr_code(qr_id):
       401:
         description: Unauthorized, invalid or expired token
       404:
-        description: QR code not found
+        description: QR code not found, or owned by another agency
       500:
         description: Server error
     """
     try:
         qr = QRCode.query.get(qr_id)
-        if not qr:
+        # another agency's code is reported as missing rather than as forbidden
+        if not qr or qr.agency_id != get_current_user().agency_id:
             return jsonify({"error": "QR code not found"}), 404
             
         data = request.get_json()
@@ -242,13 +301,35 @@ def update_qr_code(qr_id):
                 except ValueError:
                     return jsonify({"error": "Invalid expire_at date format. Use ISO format (YYYY-MM-DDTHH:MM:SS)"}), 400
         
+        if 'destination' in data:
+            if not data['destination']:
+                return jsonify({"error": "destination can't be empty"}), 400
+            try:
+                validate_target_url(data['destination'])
+            except RoutingRulesError as e:
+                return jsonify({"error": f"Invalid destination: {str(e)}"}), 400
+            qr.destination = data['destination']
+            
+        if 'routing_rules' in data:
+            if data['routing_rules'] is None:
+                qr.routing_rules = None
+            else:
+                try:
+                    compile_routing_rules(data['routing_rules'])
+                except RoutingRulesError as e:
+                    return jsonify({"error": f"Invalid routing_rules: {str(e)}"}), 400
+                qr.routing_rules = json.dumps(data['routing_rules'])
+        
         db.session.commit()
+        invalidate_qr_resolution(qr.content)
         
         return {
                 "id": qr.id,
                 "name": qr.name,
                 "agency_id": qr.agency_id,
                 "qrcode_url": qr.qrcode_url,
+                "destination": qr.destination,
+                "routing_rules": json.loads(qr.routing_rules) if qr.routing_rules else None,
                 "expire_at": qr.expire_at.isoformat() if qr.expire_at else None,
                 "created_at": qr.created_at,
                 "updated_at": qr.updated_at
@@ -274,9 +355,34 @@ def get_all_qr_codes():
         required: false
         description: Filter QR codes by agency ID
         example: 1
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, at most 200)
+      - name: after
+        in: query
+        type: string
+        required: false
+        description: Opaque cursor from the X-Next-Cursor header of the previous page
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated top-level fields to return (all when omitted)
+        example: "id,name,scanner_url,expire_at"
+      - name: stream
+        in: query
+        type: boolean
+        required: false
+        description: Stream every matching row as one JSON array instead of returning a page
     responses:
       200:
-        description: List of QR codes
+        description: Page of QR codes (or all of them when streamed), oldest first
+        headers:
+          X-Next-Cursor:
+            type: string
+            description: Cursor of the next page, absent on the last page
         schema:
           type: array
           items:
@@ -297,6 +403,9 @@ def get_all_qr_codes():
               scanner_url:
                 type: string
                 description: URL encoded in the QR code
+              destination:
+                type: string
+                description: URL users are redirected to after scanning
               expire_at:
                 type: string
                 format: date-time
@@ -315,35 +424,71 @@ def get_all_qr_codes():
       500:
         description: Server error
     """
+    limit, after = get_page_args()
+    fields = get_fields()
     try:
         agency_id = request.args.get('agency_id', type=int)
         
-        query = QRCode.query
+        query = project(QRCode, QR_LISTING_COLUMNS)
         if agency_id:
             query = query.filter_by(agency_id=agency_id)
             
-        qr_codes = query.all()
-        
         # Base URL for QR scanner endpoint
         qr_base_url = request.host_url.rstrip('/')
         
-        qr_data = [{
-            "id": qr.id,
-            "name": qr.name,
-            "agency_id": qr.agency_id,
-            "qrcode_url": qr.qrcode_url,
-            "scanner_url": f"{qr_base_url}/api/qr/{qr.content}",
-            "expire_at": qr.expire_at.isoformat() if qr.expire_at else None,
-            "is_expired": qr.expire_at and qr.expire_at < datetime.now(),
-            "created_at": qr.created_at,
-            "updated_at": qr.updated_at
-        } for qr in qr_codes]
+        if wants_stream():
+            return stream_json_array(
+                query.order_by(QRCode.id),
+                lambda qr_codes: [get_qr_listing_details(qr, qr_base_url, fields) for qr in qr_codes],
+            )
+            
+        qr_codes, next_cursor = paginate(query, [QRCode.id], limit, after)
         
-        return qr_data, 200
+        qr_data = [get_qr_listing_details(qr, qr_base_url, fields) for qr in qr_codes]
         
+        return qr_data, 200, page_headers(next_cursor)
+        
+    except PaginationError:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@qrcode_bp.route('/v1/qrcode/export', methods=['GET'])
+@jwt_required()
+def export_qr_codes():
+    """
+    Export all QR codes of the user's agency
+    ---
+    tags:
+      - QR Codes
+    security:
+      - bearerAuth: []
+    description: |
+      Streams every QR code of the authenticated user's agency as one JSON array, oldest
+      first. The response starts immediately and uses constant memory whatever the catalog size.
+    parameters:
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma separated top-level fields to return (all when omitted)
+        example: "id,name,scanner_url"
+    responses:
+      200:
+        description: JSON array of QR codes, same items as GET /v1/qrcode
+      401:
+        description: Unauthorized, invalid or expired token
+    """
+    fields = get_fields()
+    user = get_current_user()
+    
+    qr_base_url = request.host_url.rstrip('/')
+    query = project(QRCode, QR_LISTING_COLUMNS).filter_by(agency_id=user.agency_id).order_by(QRCode.id)
+    return stream_json_array(
+        query,
+        lambda qr_codes: [get_qr_listing_details(qr, qr_base_url, fields) for qr in qr_codes],
+    )
+
 @qrcode_bp.route('/v1/qrcode/<int:qr_id>', methods=['GET'])
 def get_qr_code(qr_id):
     """
@@ -379,6 +524,12 @@ def get_qr_code(qr_id):
             scanner_url:
               type: string
               description: URL encoded in the QR code
+            destination:
+              type: string
+              description: URL users are redirected to after scanning
+            routing_rules:
+              type: object
+              description: Routing rules of the QR code, if any
             expire_at:
               type: string
               format: date-time
@@ -413,6 +564,8 @@ def get_qr_code(qr_id):
                 "agency_id": qr.agency_id,
                 "qrcode_url": qr.qrcode_url,
                 "scanner_url": f"{qr_base_url}/api/qr/{qr.content}",
+                "destination": qr.destination,
+                "routing_rules": json.loads(qr.routing_rules) if qr.routing_rules else None,
                 "expire_at": qr.expire_at.isoformat() if qr.expire_at else None,
                 "is_expired": qr.expire_at and qr.expire_at < datetime.now(),
                 "created_at": qr.created_at,
@@ -438,7 +591,7 @@ def redirect_qr(qr_uuid):
         example: "a1b2c3d4e5f6"
     responses:
       302:
-        description: Redirect to the appropriate product page
+        description: Redirect to the QR code's routed destination
       404:
         description: QR code or agency not found
       410:
@@ -447,26 +600,217 @@ def redirect_qr(qr_uuid):
         description: Server error
     """
     try:
-        # Find the QR code record
-        qr = QRCode.query.filter_by(content=qr_uuid).first()
-        if not qr:
+        resolution = resolve_qr_code(qr_uuid)
+        status = get_resolution_status(resolution)
+        if status == "not_found":
             return jsonify({"error": "QR code not found"}), 404
             
         # Check if QR code has expired
-        if qr.expire_at and qr.expire_at < datetime.now():
+        if status == "expired":
             return jsonify({"error": "This QR code has expired"}), 410
             
-        # Get agency information to confirm it exists
-        agency = Agency.query.get(qr.agency_id)
-        if not agency:
+        # Confirm the agency still exists
+        if status == "agency_not_found":
             return jsonify({"error": "Agency not found"}), 404
             
-        # Determine frontend URL (in a real app, this would come from configuration)
-        # Here I'm using a query parameter approach, but you can structure this however your frontend expects
-        frontend_url = f"{request.host_url}/api/v1/product/agency/{qr.agency_id}"
+        record_scan(resolution.qr_id, get_scanner_fingerprint(request))
         
-        # Redirect to frontend with agency ID
-        return redirect(frontend_url, code=302)
+        # Redirect to the destination picked by the code's compiled routing rules
+        target = build_redirect_target(resolution, request.host_url, request.headers.get('User-Agent', ''))
+        return redirect(target, code=302)
         
     except Exception as e:
         return jsonify({"error": f"Database error: {str(e)}"}), 500
+
+
+@qrcode_bp.route('/v1/qrcode/resolve', methods=['POST'])
+@jwt_required()
+def resolve_qr_codes_batch():
+    """
+    Resolve a batch of scanned QR codes
+    ---
+    tags:
+      - QR Codes
+    security:
+      - bearerAuth: []
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          required:
+            - codes
+          properties:
+            codes:
+              type: array
+              description: QR code UUIDs (the last path segment of the scanner URL), at most 5000
+              items:
+                type: string
+              example: ["a1b2c3d4e5f6", "f6e5d4c3b2a1"]
+    responses:
+      200:
+        description: Resolution of every requested code, in request order
+        schema:
+          type: object
+          properties:
+            count:
+              type: integer
+              description: Number of resolved codes
+            results:
+              type: array
+              items:
+                type: object
+                properties:
+                  code:
+                    type: string
+                    description: QR code UUID
+                  status:
+                    type: string
+                    enum: [active, expired, not_found, agency_not_found]
+                  target:
+                    type: string
+                    description: Default destination of the code (routing rules may send individual scans elsewhere), null when it does not redirect
+                  expire_at:
+                    type: string
+                    format: date-time
+                    description: Expiration date and time in ISO format
+      400:
+        description: Bad request - codes missing, not a list of strings or too many codes
+      401:
+        description: Unauthorized, invalid or expired token
+      500:
+        description: Server error
+    """
+    data = request.get_json(silent=True)
+    if not data or 'codes' not in data:
+        return jsonify({"error": "codes is required"}), 400
+
+    codes = data['codes']
+    if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+        return jsonify({"error": "codes must be a list of strings"}), 400
+
+    codes = list(dict.fromkeys(codes))
+    if len(codes) > RESOLVE_MAX_CODES:
+        return jsonify({"error": f"At most {RESOLVE_MAX_CODES} codes can be resolved per request"}), 400
+
+    try:
+        resolved = resolve_qr_codes(codes)
+        now = datetime.now()
+
+        results = []
+        for code in codes:
+            resolution = resolved[code]
+            status = get_resolution_status(resolution, now)
+            results.append({
+                "code": code,
+                "status": status,
+                "target": build_redirect_target(resolution, request.host_url) if status == "active" else None,
+                "expire_at": resolution.expire_at.isoformat() if resolution.expire_at else None,
+            })
+
+        return {"count": len(results), "results": results}, 200
+
+    except Exception as e:
+        return jsonify({"error": f"Database error: {str(e)}"}), 500
+
+
+@qrcode_bp.route('/v1/qrcode/unique-scanners', methods=['GET'])
+@jwt_required()
+def get_unique_scanners():
+    """
+    Estimate unique scanners of QR codes
+    ---
+    tags:
+      - QR Codes
+    security:
+      - bearerAuth: []
+    description: |
+      Merges the daily HyperLogLog sketches of the requested QR codes over a date range.
+      Counts are estimates with a standard error of about 1.6%.
+    parameters:
+      - name: qr_ids
+        in: query
+        type: string
+        required: true
+        description: Comma separated IDs of QR codes of the user's agency
+        example: "1,2,3"
+      - name: start
+        in: query
+        type: string
+        format: date
+        required: false
+        description: First day (UTC, YYYY-MM-DD) to include, defaults to 30 days before end
+        example: "2025-01-01"
+      - name: end
+        in: query
+        type: string
+        format: date
+        required: false
+        description: Last day (UTC, YYYY-MM-DD) to include, defaults to today
+        example: "2025-01-31"
+    responses:
+      200:
+        description: Unique scanner estimates
+        schema:
+          type: object
+          properties:
+            unique_scanners:
+              type: integer
+              description: Estimated distinct scanners across all requested codes and days
+            per_qr_code:
+              type: object
+              description: Estimated distinct scanners per QR code ID
+            start:
+              type: string
+              format: date
+            end:
+              type: string
+              format: date
+      400:
+        description: Bad request - invalid qr_ids or dates
+      401:
+        description: Unauthorized, invalid or expired token
+      404:
+        description: QR code not found
+      500:
+        description: Server error
+    """
+    try:
+        qr_ids = [int(qr_id) for qr_id in request.args.get('qr_ids', '').split(',') if qr_id.strip()]
+    except ValueError:
+        return jsonify({"error": "qr_ids must be a comma separated list of integers"}), 400
+    if not qr_ids:
+        return jsonify({"error": "qr_ids is required"}), 400
+
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if 'end' in request.args else datetime.utcnow().date()
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if 'start' in request.args else end - timedelta(days=30)
+    except ValueError:
+        return jsonify({"error": "Invalid date format. Use YYYY-MM-DD"}), 400
+    if start > end:
+        return jsonify({"error": "start must not be after end"}), 400
+
+    user = get_current_user()
+
+    try:
+        qr_ids = list(dict.fromkeys(qr_ids))
+        owned = QRCode.query.with_entities(QRCode.id).filter(
+            QRCode.id.in_(qr_ids), QRCode.agency_id == user.agency_id
+        ).all()
+        if len(owned) != len(qr_ids):
+            return jsonify({"error": "QR code not found"}), 404
+
+        # include the scans this worker has not written out yet
+        flush_scan_events()
+        total, per_code = count_unique_scanners(qr_ids, start, end)
+
+        return {
+            "unique_scanners": total,
+            "per_qr_code": {str(qr_id): count for qr_id, count in per_code.items()},
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+        }, 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
@@ -0,0 +1,150 @@
+import json
+import random
+from datetime import datetime
+from functools import lru_cache, reduce
+from math import gcd
+from urllib.parse import urlsplit
+
+
+DEVICE_CLASSES = ('desktop', 'ios', 'android', 'mobile')
+DEVICE_INDEX = {device: index for index, device in enumerate(DEVICE_CLASSES)}
+HOURS_PER_WEEK = 7 * 24
+
+# Upper bound on the slots of one weighted split after dividing by the weights' gcd
+MAX_SPLIT_SLOTS = 1000
+# Upper bound on a single target weight, enough for splits in tenths of a percent
+MAX_TARGET_WEIGHT = 1000
+
+
+class RoutingRulesError(ValueError):
+    pass
+
+
+def validate_target_url(url):
+    """Scans are redirected only to absolute http(s) URLs, never javascript:, data: or the like."""
+    if not isinstance(url, str) or not url:
+        raise RoutingRulesError("url is required")
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        raise RoutingRulesError(f"invalid url: {url}")
+    if parts.scheme.lower() not in ('http', 'https') or not parts.hostname:
+        raise RoutingRulesError(f"url must be an absolute http or https URL: {url}")
+    return url
+
+
+def get_device_class(user_agent):
+    user_agent = (user_agent or '').lower()
+    if 'iphone' in user_agent or 'ipad' in user_agent or 'ipod' in user_agent:
+        return 'ios'
+    if 'android' in user_agent:
+        return 'android'
+    if 'mobile' in user_agent:
+        return 'mobile'
+    return 'desktop'
+
+
+class CompiledRoutes:
+    """
+    Routing rules flattened into a (device class, UTC hour of week) table.
+
+    Every cell holds the weighted split of the first rule matching that device and
+    hour, expanded into a tuple of URLs, so choosing a target is two index lookups
+    and one random index instead of walking the rules on every scan.
+    """
+
+    __slots__ = ('table',)
+
+    def __init__(self, table):
+        self.table = table
+
+    def choose(self, device_class, when=None):
+        when = when or datetime.utcnow()
+        slots = self.table[DEVICE_INDEX.get(device_class, 0)][when.weekday() * 24 + when.hour]
+        if slots is None:
+            return None
+        return slots[random.randrange(len(slots))]
+
+
+def _expand_split(targets):
+    if not isinstance(targets, list) or not targets:
+        raise RoutingRulesError("each rule needs a non-empty targets list")
+
+    weighted = []
+    for target in targets:
+        if not isinstance(target, dict) or not isinstance(target.get('url'), str) or not target['url']:
+            raise RoutingRulesError("each target needs a url")
+        validate_target_url(target['url'])
+        weight = target.get('weight', 1)
+        if not isinstance(weight, int) or isinstance(weight, bool) or weight < 0:
+            raise RoutingRulesError("target weight must be a non-negative integer")
+        if weight > MAX_TARGET_WEIGHT:
+            raise RoutingRulesError(f"target weight can be at most {MAX_TARGET_WEIGHT}")
+        if weight:
+            weighted.append((target['url'], weight))
+
+    if not weighted:
+        raise RoutingRulesError("at least one target needs a positive weight")
+
+    divisor = reduce(gcd, (weight for _, weight in weighted))
+    # counted before anything is built, the slots tuple is never larger than the limit
+    if sum(weight // divisor for _, weight in weighted) > MAX_SPLIT_SLOTS:
+        raise RoutingRulesError(f"weights are too fine grained, reduce them to at most {MAX_SPLIT_SLOTS} slots")
+    return tuple(url for url, weight in weighted for _ in range(weight // divisor))
+
+
+def _rule_hours(rule):
+    days = rule.get('days', list(range(7)))
+    if not isinstance(days, list) or not all(isinstance(day, int) and 0 <= day <= 6 for day in days):
+        raise RoutingRulesError("days must be a list of weekdays from 0 (Monday) to 6 (Sunday)")
+
+    hours = rule.get('hours', [0, 24])
+    if (not isinstance(hours, list) or len(hours) != 2
+            or not all(isinstance(hour, int) and 0 <= hour <= 24 for hour in hours)):
+        raise RoutingRulesError("hours must be a [start, end) pair of UTC hours between 0 and 24")
+
+    start, end = hours
+    if start < end:
+        day_hours = range(start, end)
+    else:
+        # windows such as [22, 6] wrap around midnight
+        day_hours = [hour for hour in range(24) if hour >= start or hour < end]
+
+    return {day * 24 + hour for day in days for hour in day_hours}
+
+
+def compile_routing_rules(rules):
+    """
+    Compile rules of the form
+    {"rules": [{"devices": [...], "days": [...], "hours": [start, end], "targets": [{"url", "weight"}]}]}
+    where devices, days and hours are optional and the first matching rule wins.
+    """
+    if not isinstance(rules, dict) or not isinstance(rules.get('rules'), list):
+        raise RoutingRulesError("routing rules must be an object with a rules list")
+
+    table = [[None] * HOURS_PER_WEEK for _ in DEVICE_CLASSES]
+    for rule in rules['rules']:
+        if not isinstance(rule, dict):
+            raise RoutingRulesError("each rule must be an object")
+
+        devices = rule.get('devices', list(DEVICE_CLASSES))
+        if not isinstance(devices, list) or not all(device in DEVICE_INDEX for device in devices):
+            raise RoutingRulesError(f"devices must be a list of: {', '.join(DEVICE_CLASSES)}")
+
+        slots = _expand_split(rule.get('targets'))
+        hours_of_week = _rule_hours(rule)
+        for device in devices:
+            row = table[DEVICE_INDEX[device]]
+            for hour_of_week in hours_of_week:
+                if row[hour_of_week] is None:
+                    row[hour_of_week] = slots
+
+    return CompiledRoutes(tuple(tuple(row) for row in table))
+
+
+@lru_cache(maxsize=4096)
+def get_compiled_routes(routing_rules):
+    """Compile the stored JSON text of a QR code's rules once per process."""
+    if not routing_rules:
+        return None
+    return compile_routing_rules(json.loads(routing_rules))
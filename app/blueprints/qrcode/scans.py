@@ -0,0 +1,154 @@
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from app.blueprints.qrcode.models import QRScanSketch
+from app.utils.hyperloglog import HyperLogLog
+from db.database import db
+
+
+logger = logging.getLogger(__name__)
+
+# Buffered scans are written out by a background thread every SCAN_FLUSH_INTERVAL
+# seconds, sooner once SCAN_FLUSH_MAX_EVENTS are buffered, and when the worker exits
+SCAN_FLUSH_MAX_EVENTS = 1000
+SCAN_FLUSH_INTERVAL = 30  # seconds
+
+_lock = threading.Lock()
+_pending = {}  # (qr_code_id, day) -> set of hashed scanner fingerprints
+_pending_events = 0
+_flush_requested = threading.Event()
+_flusher = None  # (pid, thread) of the flusher of this process
+
+
+def get_scanner_fingerprint(request):
+    # remote_addr is the client's address once ProxyFix has read X-Forwarded-For from
+    # the trusted proxies (TRUSTED_PROXIES); the header itself is client controlled
+    return '|'.join((
+        request.remote_addr or '',
+        request.headers.get('User-Agent', ''),
+        request.headers.get('Accept-Language', ''),
+    ))
+
+
+def record_scan(qr_code_id, fingerprint):
+    """Buffer one scan; the background flusher writes it into the daily sketches."""
+    global _pending_events
+    key = (qr_code_id, datetime.utcnow().date())
+    hashed = HyperLogLog.hash_value(fingerprint)
+    with _lock:
+        _pending.setdefault(key, set()).add(hashed)
+        _pending_events += 1
+        full = _pending_events >= SCAN_FLUSH_MAX_EVENTS
+    _ensure_flusher(current_app._get_current_object())
+    if full:
+        _flush_requested.set()
+
+
+def _ensure_flusher(app):
+    # started by the first scan of each process, so workers forked after create_app get theirs
+    global _flusher
+    if _flusher is not None and _flusher[0] == os.getpid():
+        return
+    with _lock:
+        if _flusher is not None and _flusher[0] == os.getpid():
+            return
+        thread = threading.Thread(target=_flush_periodically, args=(app,), name='scan-flusher', daemon=True)
+        _flusher = (os.getpid(), thread)
+        thread.start()
+        atexit.register(_flush_in_app_context, app)
+
+
+def _flush_periodically(app):
+    while True:
+        _flush_requested.wait(SCAN_FLUSH_INTERVAL)
+        _flush_requested.clear()
+        _flush_in_app_context(app)
+
+
+def _flush_in_app_context(app):
+    try:
+        with app.app_context():
+            flush_scan_events()
+    except Exception:
+        logger.exception("couldn't flush buffered QR scans")
+
+
+def _take_pending():
+    global _pending, _pending_events
+    with _lock:
+        pending, _pending = _pending, {}
+        _pending_events = 0
+    return pending
+
+
+def _merge_into_sketches(pending):
+    qr_code_ids = {qr_code_id for qr_code_id, _ in pending}
+    days = {day for _, day in pending}
+    sketches = {
+        (sketch.qr_code_id, sketch.day): sketch
+        for sketch in QRScanSketch.query.filter(
+            QRScanSketch.qr_code_id.in_(qr_code_ids),
+            QRScanSketch.day.in_(days),
+        ).with_for_update()
+    }
+
+    for (qr_code_id, day), hashes in pending.items():
+        sketch = sketches.get((qr_code_id, day))
+        hll = HyperLogLog.from_bytes(sketch.registers) if sketch else HyperLogLog()
+        for hashed in hashes:
+            hll.add_hash(hashed)
+
+        if sketch:
+            sketch.registers = hll.to_bytes()
+        else:
+            db.session.add(
+                QRScanSketch(qr_code_id=qr_code_id, day=day, registers=hll.to_bytes())
+            )
+    db.session.commit()
+
+
+def flush_scan_events():
+    """Merge the buffered scans into the stored per-code, per-day sketches."""
+    pending = _take_pending()
+    if not pending:
+        return
+
+    # a concurrent worker may create the same (code, day) row first; the retry then updates it
+    for attempt in range(2):
+        try:
+            _merge_into_sketches(pending)
+            return
+        except IntegrityError:
+            db.session.rollback()
+        except Exception:
+            db.session.rollback()
+            logger.exception("couldn't flush %d buffered QR scan sketches", len(pending))
+            return
+    logger.error("couldn't flush %d buffered QR scan sketches", len(pending))
+
+
+def count_unique_scanners(qr_code_ids, start, end):
+    """
+    Merge the stored sketches of `qr_code_ids` between the `start` and `end` days.
+    Returns the estimate over all codes and the estimate per code.
+    """
+    sketches = QRScanSketch.query.filter(
+        QRScanSketch.qr_code_id.in_(qr_code_ids),
+        QRScanSketch.day >= start,
+        QRScanSketch.day <= end,
+    ).all()
+
+    total = HyperLogLog()
+    per_code = {qr_code_id: HyperLogLog() for qr_code_id in qr_code_ids}
+    for sketch in sketches:
+        hll = HyperLogLog.from_bytes(sketch.registers)
+        per_code[sketch.qr_code_id].merge(hll)
+        total.merge(hll)
+
+    return total.count(), {qr_code_id: hll.count() for qr_code_id, hll in per_code.items()}
@@ -0,0 +1,61 @@
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from db.database import db
+
+
+# how stale a worker's view of a version may get before it asks the database again
+VERSION_CHECK_INTERVAL = 5
+
+
+class CacheVersion(db.Model):
+    """Named counters bumped whenever data cached in every worker's memory changes."""
+    __tablename__ = 'cache_version'
+
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=func.now(), onupdate=func.now())
+
+
+class VersionStamp:
+    """
+    Process-local view of one CacheVersion counter.
+
+    current() reads the counter with a primary key lookup at most once every
+    `check_interval` seconds; caches keep the version their entries were built from
+    and drop those built from an older one, so a bump made by any worker reaches every
+    other worker within that interval.
+    """
+
+    def __init__(self, name, check_interval=VERSION_CHECK_INTERVAL):
+        self.name = name
+        self.check_interval = check_interval
+        self._state = None
+
+    def current(self):
+        state = self._state
+        now = time.monotonic()
+        if state is not None and now - state[1] < self.check_interval:
+            return state[0]
+
+        version = db.session.query(CacheVersion.version).filter_by(name=self.name).scalar() or 0
+        self._state = (version, now)
+        return version
+
+    def bump(self):
+        """Move the counter on, in its own transaction; call it after the change is committed."""
+        for _ in range(2):
+            updated = CacheVersion.query.filter_by(name=self.name).update(
+                {CacheVersion.version: CacheVersion.version + 1}, synchronize_session=False
+            )
+            if not updated:
+                db.session.add(CacheVersion(name=self.name, version=1))
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                # another worker created the counter first, increment theirs
+                db.session.rollback()
+        self._state = None
@@ -0,0 +1,30 @@
+import hashlib
+
+from flask import current_app, request
+
+from db.database import db
+
+
+def get_version(*columns, criteria=()):
+    """Evaluate aggregate `columns` (e.g. max(updated_at), count(id)) in one query."""
+    return tuple(db.session.query(*columns).filter(*criteria).one())
+
+
+def check_etag(version):
+    """
+    Return the weak ETag of `version` for the current URL (query string included), and a
+    ready 304 response when the client already holds it, before anything is serialized.
+    """
+    etag = hashlib.blake2b(
+        repr((version, request.full_path)).encode(), digest_size=16
+    ).hexdigest()
+
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return etag, response
+    return etag, None
+
+
+def etag_headers(etag):
+    return {'ETag': f'W/"{etag}"'}
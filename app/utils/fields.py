@@ -0,0 +1,48 @@
+from flask import request
+
+
+class FieldSelectionError(ValueError):
+    pass
+
+
+def _split(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def get_fields():
+    """Top-level fields requested with ?fields=a,b; None when every field is wanted."""
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    return _split(fields)
+
+
+def get_expand(allowed, default):
+    """
+    Relations requested with ?expand=a,b. Without the parameter the endpoint's default
+    relations are expanded; an empty ?expand= expands none.
+    """
+    expand = request.args.get('expand')
+    if expand is None:
+        return set(default)
+
+    expand = _split(expand)
+    unknown = expand - set(allowed)
+    if unknown:
+        raise FieldSelectionError(
+            f"can't expand {', '.join(sorted(unknown))}, expandable relations are: {', '.join(allowed)}"
+        )
+    return expand
+
+
+def get_effective_expand(expand, fields):
+    # a relation left out of ?fields= is never loaded, even when it would be expanded
+    if fields is None:
+        return set(expand)
+    return set(expand) & fields
+
+
+def select_fields(payload, fields):
+    if fields is None:
+        return payload
+    return {key: value for key, value in payload.items() if key in fields}
@@ -0,0 +1,30 @@
+from flask import request
+
+
+class FilterError(ValueError):
+    pass
+
+
+_BOOLEANS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+def get_int_arg(name):
+    """Integer filter ?name=; None when absent."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise FilterError(f"{name} must be an integer")
+
+
+def get_bool_arg(name):
+    """Boolean filter ?name=true|false (or 1|0); None when absent."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return _BOOLEANS[value.lower()]
+    except KeyError:
+        raise FilterError(f"{name} must be true or false")
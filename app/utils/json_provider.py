@@ -0,0 +1,79 @@
+import dataclasses
+import decimal
+import enum
+import json
+import uuid
+from datetime import date, time
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(o):
+    # orjson handles datetimes, dates and enums natively, the stdlib fallback gets them here
+    if isinstance(o, (date, time)):
+        return o.isoformat()
+
+    if isinstance(o, enum.Enum):
+        return o.value
+
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider encoding with orjson when it is installed and with the stdlib otherwise.
+
+    Datetimes and dates are written in ISO 8601 (the format agency payloads already used),
+    enums as their value and Decimal/UUID as strings, whichever encoder is in use.
+    """
+
+    def _orjson_option(self, indent=None, sort_keys=None):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            kwargs.setdefault("default", _default)
+            kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+            kwargs.setdefault("sort_keys", self.sort_keys)
+            return json.dumps(obj, **kwargs)
+
+        option = self._orjson_option(kwargs.get("indent"), kwargs.get("sort_keys"))
+        return orjson.dumps(obj, default=_default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return json.loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(
+            obj,
+            default=_default,
+            option=self._orjson_option(indent) | orjson.OPT_APPEND_NEWLINE,
+        )
+        # the encoded bytes go straight into the response, without a str round trip
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -0,0 +1,68 @@
+from flask import g, has_app_context
+
+
+class Loader:
+    """
+    Request-scoped identity map for lookups by (model, column, value).
+
+    Values primed for a model are fetched together with one IN query the first time
+    any of them is loaded, and every result (including misses) is memoized for the rest
+    of the request, so serializing the same agency, role or address again is free.
+    """
+
+    def __init__(self):
+        self._loaded = {}
+        self._pending = {}
+
+    def prime(self, model, values, column='id'):
+        """Queue `values` so the next load of this model and column fetches them in the same query."""
+        key = (model, column)
+        loaded = self._loaded.setdefault(key, {})
+        pending = self._pending.setdefault(key, set())
+        pending.update(value for value in values if value is not None and value not in loaded)
+
+    def load(self, model, value, column='id'):
+        if value is None:
+            return None
+        loaded = self._loaded.get((model, column), {})
+        if value not in loaded:
+            self.prime(model, [value], column)
+            self._fetch(model, column)
+            loaded = self._loaded[(model, column)]
+        return loaded[value]
+
+    def load_many(self, model, values, column='id'):
+        values = list(values)
+        self.prime(model, values, column)
+        self._fetch(model, column)
+        loaded = self._loaded[(model, column)]
+        return [loaded.get(value) for value in values]
+
+    def clear(self):
+        """Forget every memoized row, e.g. between the batches of a streamed response."""
+        self._loaded.clear()
+        self._pending.clear()
+
+    def _fetch(self, model, column):
+        key = (model, column)
+        pending = self._pending.pop(key, None)
+        if not pending:
+            return
+
+        loaded = self._loaded[key]
+        by_id = self._loaded.setdefault((model, 'id'), {})
+        # ordered by id so the row kept for a non-unique column is the one .first() returned
+        for instance in model.query.filter(getattr(model, column).in_(pending)).order_by(model.id):
+            loaded.setdefault(getattr(instance, column), instance)
+            by_id.setdefault(instance.id, instance)
+        for value in pending:
+            loaded.setdefault(value, None)
+
+
+def get_loader():
+    """Return the loader of the current request (a throwaway one outside an app context)."""
+    if not has_app_context():
+        return Loader()
+    if 'loader' not in g:
+        g.loader = Loader()
+    return g.loader
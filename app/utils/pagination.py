@@ -0,0 +1,114 @@
+import base64
+import bisect
+import json
+from datetime import datetime
+
+from flask import request
+from sqlalchemy import and_, or_
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    encoded = [{'$dt': value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(encoded, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list):
+            raise ValueError
+        return [
+            datetime.fromisoformat(value['$dt']) if isinstance(value, dict) else value
+            for value in values
+        ]
+    except (ValueError, TypeError, KeyError):
+        raise PaginationError("invalid cursor")
+
+
+def get_page_args():
+    """Read `limit` and `after` from the query string; limit is capped at MAX_PAGE_SIZE."""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise PaginationError("limit must be an integer")
+    if limit < 1:
+        raise PaginationError("limit must be positive")
+
+    after = request.args.get('after')
+    return min(limit, MAX_PAGE_SIZE), decode_cursor(after) if after else None
+
+
+def _after(columns, values):
+    # (a, b) > (x, y) spelled out, which every dialect supports
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column > value
+    return or_(column > value, and_(column == value, _after(columns[1:], values[1:])))
+
+
+def _matches_type(column, value):
+    # a crafted cursor must fail here rather than as a database error
+    python_type = column.type.python_type
+    if isinstance(value, bool):
+        return python_type is bool
+    if python_type is float and isinstance(value, int):
+        return True
+    return isinstance(value, python_type)
+
+
+def paginate(query, columns, limit=None, after=None):
+    """
+    Return one page of `query` ordered by `columns` (non-null, the last one unique) and the
+    cursor of the next page, or None on the last page. Without arguments the page is read
+    from the request's query string.
+    """
+    if limit is None:
+        limit, after = get_page_args()
+
+    if after is not None:
+        if len(after) != len(columns) or not all(map(_matches_type, columns, after)):
+            raise PaginationError("invalid cursor")
+        query = query.filter(_after(columns, after))
+
+    rows = query.order_by(*columns).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column in columns])
+
+
+def paginate_sorted(items, key, limit=None, after=None):
+    """paginate() for a list already sorted by the unique attribute `key`, such as one held in memory."""
+    if limit is None:
+        limit, after = get_page_args()
+
+    start = 0
+    if after is not None:
+        if len(after) != 1:
+            raise PaginationError("invalid cursor")
+        try:
+            start = bisect.bisect_right(items, after[0], key=lambda item: getattr(item, key))
+        except TypeError:
+            raise PaginationError("invalid cursor")
+
+    rows = items[start:start + limit]
+    if start + limit >= len(items):
+        return rows, None
+    return rows, encode_cursor([getattr(rows[-1], key)])
+
+
+def page_headers(next_cursor):
+    return {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
@@ -0,0 +1,63 @@
+import functools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from config.config import Config
+
+
+# Hashing runs on a small pool instead of the request threads: at most this many hashes
+# use CPU at once (hashlib releases the GIL while it works), so a burst of logins or
+# sign-ups waits in the queue rather than starving every other request of the worker.
+_executor = ThreadPoolExecutor(
+    max_workers=Config.PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash'
+)
+
+
+def hash_password(password):
+    """Hash with PASSWORD_HASH_METHOD, any werkzeug method string ("scrypt:32768:8:1", "pbkdf2:sha256:600000", ...)."""
+    return _executor.submit(generate_password_hash, password, Config.PASSWORD_HASH_METHOD).result()
+
+
+# Batches (bulk invites) get their own processes, started on first use, so hundreds of
+# hashes never queue ahead of the login checks on the pool above.
+_bulk_executor = None
+_bulk_executor_lock = threading.Lock()
+# forking a worker that already runs threads (the pool above, the scan flusher, a threaded
+# server) can copy a held lock into the child; these start from a clean single-threaded process
+_BULK_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def _get_bulk_executor():
+    global _bulk_executor
+    with _bulk_executor_lock:
+        if _bulk_executor is None:
+            _bulk_executor = ProcessPoolExecutor(
+                max_workers=Config.PASSWORD_BULK_HASH_WORKERS,
+                mp_context=multiprocessing.get_context(_BULK_START_METHOD),
+            )
+        return _bulk_executor
+
+
+def hash_passwords(passwords):
+    """Hash many passwords at once on the bulk process pool, in order."""
+    return list(_get_bulk_executor().map(
+        generate_password_hash, passwords, [Config.PASSWORD_HASH_METHOD] * len(passwords), chunksize=16
+    ))
+
+
+def verify_password(password_hash, password):
+    return _executor.submit(check_password_hash, password_hash, password).result()
+
+
+@functools.lru_cache(maxsize=None)
+def _method_prefix(method):
+    # werkzeug spells out the defaults in the hash ("scrypt" becomes "scrypt:32768:8:1")
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash):
+    """Whether the hash was made with another method or cost than the configured one."""
+    return password_hash.split('$', 1)[0] != _method_prefix(Config.PASSWORD_HASH_METHOD)
@@ -0,0 +1,137 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+SERVER_TIMING_HEADER = 'Server-Timing'
+# the same statement shape run this many times in one request is reported as an N+1 suspect
+N_PLUS_ONE_THRESHOLD = 5
+
+_PARAMETER = re.compile(r"%\(\w+\)s|%s|\?|:\w+|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN \((?:\?, )*\?\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+_local = threading.local()
+
+
+def normalize_statement(statement):
+    """Shape of a SQL statement: literals and bound parameters replaced, IN lists collapsed."""
+    shape = _PARAMETER.sub('?', _WHITESPACE.sub(' ', statement).strip())
+    return _IN_LIST.sub('IN (?)', shape)
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[normalize_statement(statement)] += 1
+
+    def suspects(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Statement shapes repeated at least `threshold` times, most repeated first."""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+def _collectors():
+    collectors = list(getattr(_local, 'stack', ()))
+    if has_app_context() and 'query_stats' in g:
+        collectors.append(g.query_stats)
+    return collectors
+
+
+# the start time lives on the statement's execution context, which a failed statement
+# simply drops, so nothing is left behind on the pooled connection
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context._query_started_at
+    for stats in _collectors():
+        stats.record(statement, duration)
+
+
+def _listen():
+    # the listeners time every statement, so they are only added once something collects
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+@contextmanager
+def count_queries():
+    """Collect the statements run inside the block, in any app or request context."""
+    _listen()
+    stats = QueryStats()
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(stats)
+    try:
+        yield stats
+    finally:
+        _local.stack.remove(stats)
+
+
+@contextmanager
+def query_budget(limit):
+    """
+    Fail with AssertionError when the block runs more than `limit` statements, e.g.
+
+        with query_budget(9):
+            client.get('/api/v1/product?limit=200', headers=headers)
+    """
+    with count_queries() as stats:
+        yield stats
+
+    if stats.count > limit:
+        shapes = '\n'.join(f'  {count} x {shape}' for shape, count in stats.shapes.most_common())
+        raise AssertionError(f"{stats.count} queries run, the budget is {limit}:\n{shapes}")
+
+
+def init_query_stats(app, report=True):
+    """
+    With `report`, time every statement through engine events: each request gets
+    X-Query-Count and Server-Timing headers and repeated statement shapes are logged.
+    Without it nothing is added, and only count_queries() blocks pay for the events.
+
+    Streamed responses get no headers: their queries run while the body is sent, after
+    the headers are gone.
+    """
+    if not report:
+        return
+
+    _listen()
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.pop('query_stats', None)
+        # a streamed body hasn't run its queries yet, any count would read 0
+        if stats is None or response.is_streamed:
+            return response
+
+        response.headers[QUERY_COUNT_HEADER] = str(stats.count)
+        response.headers.add(
+            SERVER_TIMING_HEADER, f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries"'
+        )
+        for shape, count in stats.suspects():
+            logger.warning(
+                "possible N+1 on %s %s: %d x %s", request.method, request.path, count, shape
+            )
+        return response
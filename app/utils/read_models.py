@@ -0,0 +1,12 @@
+from db.database import db
+
+
+def project(model, columns):
+    """
+    Query of only `columns` of `model`, returning Row tuples instead of entities.
+
+    Rows expose their columns as attributes the way entities do, so serializers written
+    for entities take them as they are, but skip the identity map, change tracking and
+    every column left out (large text bodies, password hashes).
+    """
+    return db.session.query(*(getattr(model, column) for column in columns))
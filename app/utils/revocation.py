@@ -0,0 +1,120 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from db.database import db
+
+
+# how long a token revoked by another worker may still be accepted by this one
+REVOCATION_REFRESH_INTERVAL = 5
+# rows are re-read this far behind the newest one seen, for transactions committed late
+REVOCATION_OVERLAP = timedelta(seconds=30)
+
+
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_tokens'
+
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), unique=True, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=func.now(), index=True)
+
+
+def _compact(jti):
+    # flask_jwt_extended issues uuid4 jtis: 16 bytes instead of a 36 character string
+    try:
+        return uuid.UUID(jti).bytes
+    except ValueError:
+        return jti.encode()
+
+
+def _utc(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+class RevocationList:
+    """
+    The jtis of revoked, not yet expired tokens, held in memory by every worker.
+
+    The first check loads the revoked_tokens table, later checks read only the rows
+    added since, at most once every `refresh_interval` seconds, so a check is a set
+    lookup and a revocation reaches every worker within that interval.
+    """
+
+    def __init__(self, refresh_interval=REVOCATION_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        # compact jti -> expiry, in epoch seconds
+        self._revoked = {}
+        self._seen_until = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def _is_stale(self):
+        refreshed_at = self._refreshed_at
+        return refreshed_at is None or time.monotonic() - refreshed_at >= self.refresh_interval
+
+    def is_revoked(self, jti):
+        if self._is_stale():
+            self.refresh(force=False)
+        return _compact(jti) in self._revoked
+
+    def refresh(self, force=True):
+        """Read the rows added since the last refresh; unless `force`, only when the list is stale."""
+        with self._lock:
+            # the checks that queued on the lock behind a refresh have nothing left to read
+            if not force and not self._is_stale():
+                return
+            now = time.time()
+            query = db.session.query(RevokedToken.jti, RevokedToken.expires_at, RevokedToken.created_at).filter(
+                RevokedToken.expires_at > _utc(now)
+            )
+            if self._seen_until is not None:
+                query = query.filter(RevokedToken.created_at >= self._seen_until - REVOCATION_OVERLAP)
+
+            revoked = dict(self._revoked)
+            for jti, expires_at, created_at in query:
+                revoked[_compact(jti)] = expires_at.replace(tzinfo=timezone.utc).timestamp()
+                if self._seen_until is None or created_at > self._seen_until:
+                    self._seen_until = created_at
+            # expired tokens are rejected anyway, they don't need to be remembered
+            self._revoked = {jti: expires for jti, expires in revoked.items() if expires > now}
+            self._refreshed_at = time.monotonic()
+
+    def revoke(self, jti, expires):
+        """Revoke the token `jti`, valid until `expires` (its exp claim)."""
+        db.session.add(RevokedToken(jti=jti, expires_at=_utc(expires)))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # already revoked
+            db.session.rollback()
+        with self._lock:
+            self._revoked[_compact(jti)] = expires
+
+    def purge(self):
+        """Delete the rows of tokens that have expired since they were revoked."""
+        deleted = RevokedToken.query.filter(RevokedToken.expires_at <= _utc(time.time())).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+        return deleted
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+revocation_list = RevocationList()
+
+
+def register_revocation_check(jwt):
+    @jwt.token_in_blocklist_loader
+    def check_if_token_revoked(_jwt_header, jwt_payload):
+        return revocation_list.is_revoked(jwt_payload["jti"])
+
+    @jwt.revoked_token_loader
+    def revoked_token_callback(_jwt_header, jwt_payload):
+        return {"message": "token has been revoked"}, 401
@@ -0,0 +1,55 @@
+import csv
+import json
+import os
+
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+from db.database import db
+
+
+# dialects whose INSERT can skip rows that hit a unique constraint
+_CONFLICT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def load_fixture(path):
+    """Rows of a fixture file: a JSON array of objects, or a CSV file with a header row."""
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, newline='', encoding='utf-8') as fixture:
+            # empty CSV cells are missing values, not empty strings
+            return [
+                {name: value if value != '' else None for name, value in row.items()}
+                for row in csv.DictReader(fixture)
+            ]
+    with open(path, encoding='utf-8') as fixture:
+        return json.load(fixture)
+
+
+def insert_missing(model, rows, key, criteria=()):
+    """
+    Insert the `rows` (dicts of column values) whose `key` columns match no row of
+    `model` (among those matching `criteria`) yet, in the session's transaction;
+    returns the number of rows inserted.
+
+    The existing keys are read with one query and the rest goes in one executemany
+    INSERT, with ON CONFLICT DO NOTHING where the dialect has it so a seeder running
+    concurrently can't fail the transaction. Seeding the same rows again only reads keys.
+    """
+    existing = {
+        tuple(row) for row in db.session.query(*(getattr(model, name) for name in key)).filter(*criteria)
+    }
+    missing = {}
+    for row in rows:
+        identity = tuple(row[name] for name in key)
+        if identity not in existing and identity not in missing:
+            missing[identity] = row
+    if not missing:
+        return 0
+
+    table = model.__table__
+    conflict_insert = _CONFLICT_INSERTS.get(db.session.get_bind().dialect.name)
+    statement = insert(table) if conflict_insert is None else conflict_insert(table).on_conflict_do_nothing()
+    # executemany needs the same keys in every row; a column some rows leave out is NULL in them
+    names = set().union(*missing.values())
+    db.session.execute(statement, [{name: row.get(name) for name in names} for row in missing.values()])
+    return len(missing)
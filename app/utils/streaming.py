@@ -0,0 +1,41 @@
+from flask import Response, current_app, request, stream_with_context
+
+from app.utils.loader import get_loader
+
+
+STREAM_BATCH_SIZE = 500
+
+
+def wants_stream():
+    return request.args.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def stream_json_array(query, serialize_batch, batch_size=STREAM_BATCH_SIZE):
+    """
+    Stream every row of `query` as one JSON array.
+
+    Rows are read with yield_per and handed to `serialize_batch` (rows -> list of dicts)
+    `batch_size` at a time, so memory stays flat and the first bytes leave before the
+    last rows are read. The request loader is cleared between batches for the same reason.
+    """
+    def generate():
+        yield '['
+        separator = ''
+        batch = []
+        for row in query.yield_per(batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield separator + _dump_batch(serialize_batch(batch))
+                separator = ','
+                batch = []
+                get_loader().clear()
+        if batch:
+            yield separator + _dump_batch(serialize_batch(batch))
+        yield ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def _dump_batch(items):
+    dumps = current_app.json.dumps
+    return ','.join(dumps(item) for item in items)
@@ -0,0 +1,135 @@
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from db.database import db
+
+
+class ThrottleBucket(db.Model):
+    """Token buckets shared by every worker when throttles use DatabaseBucketStore."""
+    __tablename__ = 'throttle_bucket'
+
+    key = db.Column(db.String(255), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    # epoch seconds, comparable across processes and hosts
+    updated_at = db.Column(db.Float, nullable=False, index=True)
+
+
+def _refill(tokens, elapsed, capacity, rate):
+    return min(capacity, tokens + max(elapsed, 0) * rate)
+
+
+def _take(tokens, capacity, rate):
+    """Take one token from a bucket holding `tokens`: (allowed, tokens left, seconds until the next token)."""
+    if tokens >= 1:
+        return True, tokens - 1, 0
+    return False, tokens, (1 - tokens) / rate
+
+
+class MemoryBucketStore:
+    """Buckets held by this process only; each worker then allows its own budget."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, refill_seconds):
+        # buckets are evicted by idleness order, not by age
+        pass
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            allowed, tokens, retry_after = _take(_refill(tokens, now - updated_at, capacity, rate), capacity, rate)
+            self._buckets[key] = (tokens, now)
+            # touched keys move to the end, so the first bucket is the idlest
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+
+class DatabaseBucketStore:
+    """Buckets in the throttle_bucket table, so every worker draws from the same budget."""
+
+    PURGE_EVERY = 1000
+
+    def __init__(self):
+        self._takes = 0
+        # the longest any throttle drawing from this store takes to refill an empty bucket
+        self.idle_seconds = 0
+
+    def register(self, refill_seconds):
+        """Note a throttle whose buckets need `refill_seconds` idle to be full again."""
+        self.idle_seconds = max(self.idle_seconds, refill_seconds)
+
+    def take(self, key, capacity, rate):
+        table = ThrottleBucket.__table__
+        for attempt in range(2):
+            now = time.time()
+            try:
+                # its own transaction, committed whatever the request does next
+                with db.engine.begin() as connection:
+                    row = connection.execute(
+                        select(table.c.tokens, table.c.updated_at).where(table.c.key == key).with_for_update()
+                    ).first()
+                    tokens = capacity if row is None else _refill(row.tokens, now - row.updated_at, capacity, rate)
+                    allowed, tokens, retry_after = _take(tokens, capacity, rate)
+                    if row is None:
+                        connection.execute(insert(table).values(key=key, tokens=tokens, updated_at=now))
+                    else:
+                        connection.execute(
+                            update(table).where(table.c.key == key).values(tokens=tokens, updated_at=now)
+                        )
+                break
+            except IntegrityError:
+                # another worker created the bucket first, take from theirs
+                if attempt:
+                    raise
+
+        self._takes += 1
+        if self._takes % self.PURGE_EVERY == 0:
+            # the buckets of every throttle sharing the store are purged, so wait for the slowest refill
+            self.purge(max(self.idle_seconds, capacity / rate))
+        return allowed, retry_after
+
+    def purge(self, idle_seconds):
+        """Drop buckets idle long enough to be full again, which is what a missing bucket means."""
+        with db.engine.begin() as connection:
+            connection.execute(
+                delete(ThrottleBucket.__table__).where(ThrottleBucket.updated_at < time.time() - idle_seconds)
+            )
+
+
+class Throttle:
+    """
+    Token bucket limiter: each key may spend `capacity` attempts at once, and earns
+    `per_minute` attempts back every minute.
+    """
+
+    def __init__(self, name, capacity, per_minute, store):
+        self.name = name
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.store = store
+        store.register(capacity / self.rate)
+        self.counters = Counter()
+
+    def hit(self, key):
+        """Spend one attempt for `key`; None when allowed, else the seconds to wait."""
+        allowed, retry_after = self.store.take(f"{self.name}:{key}", self.capacity, self.rate)
+        self.counters['allowed' if allowed else 'rejected'] += 1
+        return None if allowed else max(1, math.ceil(retry_after))
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "per_minute": self.rate * 60,
+            "allowed": self.counters['allowed'],
+            "rejected": self.counters['rejected'],
+        }
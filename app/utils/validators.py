@@ -1,11 +1,11 @@
 import random
 import re
-from werkzeug.security import generate_password_hash
+from app.utils.passwords import hash_password
 
 
 
 def set_password(password):
-    password_hash = generate_password_hash(password)
+    password_hash = hash_password(password)
     return password_hash
 
 
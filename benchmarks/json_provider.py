@@ -0,0 +1,121 @@
+"""
+Microbenchmark of Flask's default JSON provider against FastJSONProvider on
+representative product and QR code list payloads.
+
+    python -m benchmarks.json_provider [--rows 500] [--repeat 20]
+"""
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from app.utils.json_provider import FastJSONProvider, orjson
+
+
+def agency_payload(agency_id, now):
+    return {
+        "id": agency_id,
+        "name": f"Agency {agency_id}",
+        "icon": f"https://cdn.example.com/icons/{agency_id}.png",
+        "is_subscribed": "basic",
+        "monthly_qr_limit": 5,
+        "address": {
+            "city": {"id": 1, "name": "Los Angeles"},
+            "state": {"id": 1, "name": "California"},
+            "country": {"id": 1, "name": "United States"},
+            "street_address": "1 Main Street",
+        },
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
+    }
+
+
+def product_payloads(rows, now):
+    agency = agency_payload(1, now)
+    user = {
+        "id": 1,
+        "email": "owner@example.com",
+        "first_name": "Jane",
+        "last_name": "Doe",
+        "phone_number": "+31612345678",
+        "role": {"id": 2, "name": "ADMIN"},
+        "profile": {"id": 1, "phone_number": "+31612345678", "is_visible": True},
+        "is_verified": True,
+        "is_active": True,
+        "user_type": "ADMIN",
+        "created_at": now,
+        "updated_at": now,
+    }
+    return [
+        {
+            "id": index,
+            "name": f"Product {index}",
+            "description": "A high-quality widget for all your needs. " * 4,
+            "price": 29.99 + index,
+            "image_url": f"https://cdn.example.com/products/{index}.jpg",
+            "created_at": now - timedelta(minutes=index),
+            "updated_at": now,
+            "agency": agency,
+            "created_by": user,
+        }
+        for index in range(rows)
+    ]
+
+
+def qr_payloads(rows, now):
+    return [
+        {
+            "id": index,
+            "name": f"Table {index}",
+            "agency_id": 1,
+            "qrcode_url": f"https://cdn.example.com/qr/{index}.png",
+            "scanner_url": f"https://api.example.com/api/qr/{index:032x}",
+            "destination": "https://menu.example.com/1",
+            "expire_at": (now + timedelta(days=30)).isoformat(),
+            "is_expired": False,
+            "created_at": now - timedelta(minutes=index),
+            "updated_at": now,
+        }
+        for index in range(rows)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    providers = {
+        "default": DefaultJSONProvider(app),
+        "fast" if orjson else "fast (orjson missing, stdlib)": FastJSONProvider(app),
+    }
+
+    now = datetime.now()
+    payloads = {
+        f"{args.rows} products": product_payloads(args.rows, now),
+        f"{args.rows} QR codes": qr_payloads(args.rows, now),
+    }
+
+    for payload_name, payload in payloads.items():
+        print(payload_name)
+        baseline = None
+        for provider_name, provider in providers.items():
+            with app.app_context():
+                seconds = min(timeit.repeat(
+                    lambda: provider.response(payload),
+                    number=args.repeat,
+                    repeat=5,
+                )) / args.repeat
+            baseline = baseline or seconds
+            print(
+                f"  {provider_name:<32} {seconds * 1000:8.2f} ms/response"
+                f"  {args.rows / seconds:12,.0f} rows/s  x{baseline / seconds:.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
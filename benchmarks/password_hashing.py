@@ -0,0 +1,51 @@
+"""
+Password checks per second, and per core, for werkzeug hashing methods run the way login
+runs them: many request threads at once, hashing on the bounded pool.
+
+    python -m benchmarks.password_hashing [--logins 64] [--threads 32] [--method scrypt ...]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+from app.utils import passwords
+from config.config import Config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=32, help="concurrent request threads")
+    parser.add_argument(
+        "--method",
+        action="append",
+        help="werkzeug method string, may be repeated",
+    )
+    args = parser.parse_args()
+
+    methods = args.method or ["scrypt:32768:8:1", "scrypt:16384:8:1", "pbkdf2:sha256:600000", "pbkdf2:sha256:100000"]
+    workers = Config.PASSWORD_HASH_WORKERS
+    cores = min(workers, os.cpu_count() or 1)
+    print(f"{workers} hashing workers, {cores} core(s) used, {args.threads} request threads")
+
+    for method in methods:
+        password_hash = generate_password_hash("Passw0rd!", method)
+        with ThreadPoolExecutor(max_workers=args.threads) as requests:
+            started = time.perf_counter()
+            results = list(requests.map(
+                lambda _: passwords.verify_password(password_hash, "Passw0rd!"), range(args.logins)
+            ))
+            seconds = time.perf_counter() - started
+        assert all(results)
+        print(
+            f"  {method:<24} {args.logins / seconds:8.1f} logins/s"
+            f"  {args.logins / seconds / cores:8.1f} logins/s/core"
+            f"  {seconds / args.logins * 1000:8.1f} ms/login"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Loading a product listing as Product entities against the projected rows the list
+endpoints read, on an in-memory SQLite database.
+
+    python -m benchmarks.read_models [--rows 5000] [--repeat 5] [--description-size 2000]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from flask import Flask
+
+from app.blueprints.agency.models import Agency
+from app.blueprints.auth.models import User
+from app.blueprints.category.models import Category
+from app.blueprints.product.methods import get_product_listing_columns
+from app.blueprints.product.models import Product
+from app.utils.read_models import project
+from db.database import db
+
+
+def seed(rows, description_size):
+    db.session.add(Agency(id=1, name="Agency", address_id=1))
+    db.session.add(User(id=1, email="owner@example.com", agency_id=1))
+    db.session.execute(
+        Product.__table__.insert(),
+        [
+            {
+                "name": f"Product {index}",
+                "description": "x" * description_size,
+                "price": 29.99,
+                "image_url": f"https://cdn.example.com/products/{index}.jpg",
+                "agency_id": 1,
+                "created_by": 1,
+                "is_visible": True,
+            }
+            for index in range(rows)
+        ],
+    )
+    db.session.commit()
+
+
+def measure(load, repeat):
+    seconds = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        rows = load()
+        seconds.append(time.perf_counter() - started)
+
+    db.session.expunge_all()
+    gc.collect()
+    tracemalloc.start()
+    rows = load()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(rows), min(seconds), memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--description-size", type=int, default=2000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        seed(args.rows, args.description_size)
+
+        loads = {
+            "Product entities": lambda: Product.query.filter_by(agency_id=1, is_visible=True).all(),
+            "projected rows": lambda: project(Product, get_product_listing_columns())
+                .filter_by(agency_id=1, is_visible=True).all(),
+            "projected rows, no description": lambda: project(Product, get_product_listing_columns({"id", "name"}))
+                .filter_by(agency_id=1, is_visible=True).all(),
+        }
+
+        for name, load in loads.items():
+            rows, seconds, memory = measure(load, args.repeat)
+            print(
+                f"{name:<32} {rows / seconds:12,.0f} rows/s"
+                f"  {memory / rows:8,.0f} bytes/row"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import os
 
 class Config:
     load_dotenv('.env', override=True)
+    APP_ENV=os.getenv('APP_ENV', 'production')
     SQLALCHEMY_DATABASE_URI=os.getenv('SQLALCHEMY_DATABASE_URI')
     DB_CONNECTION=os.getenv('DB_CONNECTION')
     DB_CONNECTION_GLOBAL=os.getenv('DB_CONNECTION_GLOBAL')
@@ -18,4 +19,16 @@ class Config:
     POSTGRES_USER=os.getenv('POSTGRES_USER')
     POSTGRES_PASSWORD=os.getenv('POSTGRES_PASSWORD')
     POSTGRES_HOST=os.getenv('POSTGRES_HOST')
-    POSTGRES_PORT=os.getenv('POSTGRES_PORT')
\ No newline at end of file
+    POSTGRES_PORT=os.getenv('POSTGRES_PORT')
+    PASSWORD_HASH_METHOD=os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+    PASSWORD_HASH_WORKERS=int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+    # processes hashing bulk invites; by default half the cores, the rest stay free for logins
+    PASSWORD_BULK_HASH_WORKERS=int(os.getenv('PASSWORD_BULK_HASH_WORKERS', max(1, (os.cpu_count() or 1) // 2)))
+    LOGIN_THROTTLE_STORE=os.getenv('LOGIN_THROTTLE_STORE', 'memory')  # memory or database
+    LOGIN_ACCOUNT_BURST=int(os.getenv('LOGIN_ACCOUNT_BURST', 10))
+    LOGIN_ACCOUNT_PER_MINUTE=float(os.getenv('LOGIN_ACCOUNT_PER_MINUTE', 5))
+    LOGIN_IP_BURST=int(os.getenv('LOGIN_IP_BURST', 30))
+    LOGIN_IP_PER_MINUTE=float(os.getenv('LOGIN_IP_PER_MINUTE', 30))
+    BULK_INVITE_MAX_ROWS=int(os.getenv('BULK_INVITE_MAX_ROWS', 1000))
+    # reverse proxies in front of the app whose X-Forwarded-For is trusted, 0 when clients connect directly
+    TRUSTED_PROXIES=int(os.getenv('TRUSTED_PROXIES', 0))
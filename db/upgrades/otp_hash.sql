@@ -0,0 +1,19 @@
+-- otp_reset_tokens.otp_hash in place of the plaintext otp column, for databases created before it.
+-- db.create_all() only creates missing tables, it never adds columns to existing ones.
+--
+--     psql "$DB_CONNECTION" -f db/upgrades/otp_hash.sql
+--
+-- Outstanding codes are deleted: they live 15 minutes and can't be hashed without
+-- being stored in plain text first. Users who had one simply request a new code.
+
+BEGIN;
+
+DELETE FROM otp_reset_tokens;
+
+ALTER TABLE otp_reset_tokens DROP COLUMN IF EXISTS otp;
+ALTER TABLE otp_reset_tokens ADD COLUMN IF NOT EXISTS otp_hash VARCHAR(64) NOT NULL;
+
+CREATE INDEX IF NOT EXISTS ix_otp_reset_tokens_lookup ON otp_reset_tokens (user_id, otp_hash, is_used);
+CREATE INDEX IF NOT EXISTS ix_otp_reset_tokens_expires_at ON otp_reset_tokens (expires_at);
+
+COMMIT;
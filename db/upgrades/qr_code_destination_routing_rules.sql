@@ -0,0 +1,9 @@
+-- qr_code.destination and qr_code.routing_rules, for databases created before them.
+-- db.create_all() only creates missing tables, it never adds columns to existing ones.
+--
+--     psql "$DB_CONNECTION" -f db/upgrades/qr_code_destination_routing_rules.sql
+--
+-- Codes left without a destination keep redirecting to their agency product page.
+
+ALTER TABLE qr_code ADD COLUMN IF NOT EXISTS destination VARCHAR;
+ALTER TABLE qr_code ADD COLUMN IF NOT EXISTS routing_rules TEXT;
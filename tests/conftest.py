@@ -0,0 +1,80 @@
+import pytest
+
+from config.config import Config
+from db.database import db
+
+ROWS = 30
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    # whatever .env says, the tests run against a throwaway SQLite file
+    Config.DB_CONNECTION = f"sqlite:///{tmp_path_factory.mktemp('db') / 'test.db'}"
+    Config.JWT_SECRET_KEY = Config.JWT_SECRET_KEY or 'test-' * 8
+    Config.SECRET = Config.SECRET or 'test'
+
+    from app import create_app
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+@pytest.fixture(scope='session')
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def headers(app, client):
+    """An agency admin's token, with ROWS users, categories, products and QR codes in the agency, and ROWS other agencies."""
+    from app.blueprints.address.methods import seed_cities, seed_countries, seed_states
+    from app.blueprints.address.models import Address
+    from app.blueprints.agency.models import Agency
+    from app.blueprints.auth.models import User, UserType
+    from app.blueprints.category.models import Category
+    from app.blueprints.product.models import Product
+    from app.blueprints.qrcode.models import QRCode
+
+    with app.app_context():
+        seed_countries()
+        seed_states()
+        seed_cities()
+        db.session.commit()
+    assert client.get('/api/v1/sync-roles-permission').status_code == 200
+
+    response = client.post('/api/v1/sign-up', json={
+        "first_name": "Test", "last_name": "Admin", "email": "admin@example.com",
+        "phone_number": "1234567890", "password": "Passw0rd!",
+    })
+    assert response.status_code == 200, response.json
+    headers = {"Authorization": f"Bearer {response.json['access_token']}"}
+    response = client.post('/api/v1/agency', json={
+        "name": "Test Agency", "city_id": 1, "state_id": 1, "country_id": 1, "street_address": "1 Main Street",
+    }, headers=headers)
+    assert response.status_code == 201, response.json
+
+    with app.app_context():
+        admin = User.query.filter_by(email="admin@example.com").one()
+        agency_id = admin.agency_id
+        categories = [Category(name=f"Category {index}", agency_id=agency_id) for index in range(ROWS)]
+        db.session.add_all(categories)
+        db.session.flush()
+        for index in range(ROWS):
+            db.session.add(User(
+                email=f"user{index}@example.com", first_name="User", user_type=UserType.USER,
+                agency_id=agency_id, role_id=admin.role_id,
+            ))
+            db.session.add(Product(
+                name=f"Product {index}", price=index, created_by=admin.id,
+                category_id=categories[index].id, agency_id=agency_id,
+            ))
+            db.session.add(QRCode(name=f"QR {index}", content=f"qr{index}", agency_id=agency_id))
+            address = Address(street_address=f"{index} Main Street", city_id=1, state_id=1, country_id=1)
+            db.session.add(address)
+            db.session.flush()
+            db.session.add(Agency(name=f"Agency {index}", address_id=address.id))
+        db.session.commit()
+
+    return headers
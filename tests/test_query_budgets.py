@@ -0,0 +1,26 @@
+"""
+Statements run by the list endpoints, whatever the page size. Every page holds more rows
+than its budget, so loading anything per row breaks the budget.
+
+    python -m pytest tests
+"""
+import pytest
+
+from app.utils.query_stats import query_budget
+
+
+@pytest.mark.parametrize('url, budget', [
+    ('/api/v1/product?limit=100', 7),
+    ('/api/v1/product?limit=100&expand=category,created_by', 8),
+    ('/api/v1/product/agency/1?limit=100', 6),
+    ('/api/v1/agency?limit=100', 3),
+    ('/api/v1/user?limit=100', 5),
+    ('/api/v1/user?limit=100&is_active=true', 5),
+    ('/api/v1/qrcode?limit=100', 1),
+])
+def test_list_endpoint_query_budget(client, headers, url, budget):
+    with query_budget(budget):
+        response = client.get(url, headers=headers)
+
+    assert response.status_code == 200, response.json
+    assert len(response.json) > budget